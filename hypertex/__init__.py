@@ -1,11 +1,56 @@
-import hypertex.parser
-import hypertex.render.html
-import hypertex.render.tex
+# The parser and renderers are only imported when they are first used, so
+# that importing hypertex (e.g. to run bin/hypertex) is cheap, and only the
+# renderers of the formats being rendered get loaded.  (The helpers below
+# are private so as not to clash with the hypertex.render package, which
+# becomes an attribute of this module once it is imported.)
 
 def render_html(htex, parse_config={}, render_config={}):
-  parsed = hypertex.parser.parse(htex, parse_config)
-  return hypertex.render.html.render(parsed, render_config)
+  return _render(htex, "html", parse_config, render_config)
 
 def render_tex(htex, parse_config={}, render_config={}):
+  return _render(htex, "tex", parse_config, render_config)
+
+def _render(htex, format, parse_config={}, render_config={}):
+  import hypertex.parser
+  from hypertex.render import renderer
+  parsed = hypertex.parser.parse(htex, parse_config)
+  return renderer(format).render(parsed, render_config)
+
+def render_many(htex, formats, parse_config={}, render_configs={}, jobs=1):
+  """
+  Parse htex once and render it in each of the given formats, with the
+  render config of each format taken from render_configs.  Returns a dict
+  format => output.  The renderers only read the parsed document, so with
+  jobs > 1 they run at the same time on that many threads (which helps when
+  formula images are being rendered).
+  """
+  import hypertex.parser
+  from hypertex.render import renderer
   parsed = hypertex.parser.parse(htex, parse_config)
-  return hypertex.render.tex.render(parsed, render_config)
+  # import them here rather than on the threads
+  renderers = dict((format, renderer(format)) for format in formats)
+  work = lambda format: renderers[format].render(parsed,
+    render_configs.get(format, {}))
+  if jobs <= 1 or len(formats) <= 1:
+    outputs = map(work, formats)
+  else:
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(formats)))
+    try:
+      outputs = pool.map(work, formats)
+    finally:
+      pool.close()
+      pool.join()
+  return dict(zip(formats, outputs))
+
+def stream_html(path, parse_config={}, render_config={}):
+  return _stream(path, "html", parse_config, render_config)
+
+def stream_tex(path, parse_config={}, render_config={}):
+  return _stream(path, "tex", parse_config, render_config)
+
+def _stream(path, format, parse_config={}, render_config={}):
+  import hypertex.parser
+  from hypertex.render import renderer
+  parsed = hypertex.parser.iterparse(path, parse_config)
+  return renderer(format).render_stream(parsed, render_config)
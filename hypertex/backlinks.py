@@ -0,0 +1,165 @@
+__name__ = "backlinks"
+
+import os
+import json
+import tempfile
+
+import hypertex.parser
+from hypertex import instrument
+
+BACKLINKS_VERSION = 1
+
+_indices = {}
+
+def _add_links(node, n, links):
+  if type(node) in (str, unicode):
+    return links
+  if node.get("type") in ("citation", "term") and node.get("tag"):
+    links.add(hypertex.parser._parse_partag(node.get("tag")) + (n,))
+  for x in node.get("content"):
+    _add_links(x, n, links)
+  return links
+
+def links_of(parsed):
+  """
+  Return the sorted list of the citations and terms in a parsed document,
+  as triples (doc, tag, n): the n-th par cites the par with tag `tag` in the
+  document `doc`, which is "" for the document itself.
+  """
+  links = set()
+  for (i, p) in enumerate(parsed["body"]["pars"]):
+    _add_links(p, i + 1, links)
+  return sorted(links)
+
+class BacklinkIndex(object):
+  """
+  A map from the pars of the documents in src_dir to the pars which cite
+  them (with a citation or a term).
+
+  Only the citations made by each document are stored, in the file at path
+  if one is given; the reverse map doc => tag => citing pars is made from
+  them when the index is loaded, and kept up to date as documents are
+  recorded, so that looking up the pars citing a tag takes constant time.
+  Call refresh() to bring the index up to date with src_dir.
+  """
+
+  def __init__(self, src_dir, path=None):
+    self.src_dir = src_dir
+    self.path = path
+    # doc => {"mtime", "size", "hash", "links": [[doc, tag, n], ...]}
+    self.docs = {}
+    # cited doc => tag => set of (citing doc, par number)
+    self.reverse = {}
+    self.dirty = False
+    if path:
+      self._load()
+
+  def _load(self):
+    try:
+      data = json.load(open(self.path, "r"))
+    except (IOError, ValueError):
+      return
+    if data.get("version") != BACKLINKS_VERSION:
+      return
+    self.docs = data.get("docs", {})
+    for (doc, entry) in self.docs.items():
+      self._link(doc, entry["links"])
+
+  def save(self):
+    if not self.path or not self.dirty:
+      return
+    dirname = os.path.dirname(self.path)
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    (f, tmppath) = tempfile.mkstemp(dir=dirname)
+    with os.fdopen(f, "w") as out:
+      json.dump({"version": BACKLINKS_VERSION, "docs": self.docs}, out,
+        separators=(",", ":"))
+    os.rename(tmppath, self.path)
+    self.dirty = False
+
+  def _link(self, doc, links):
+    for (d, tag, n) in links:
+      self.reverse.setdefault(d or doc, {}).setdefault(tag, set()).add(
+        (doc, n))
+
+  def _unlink(self, doc, links):
+    for (d, tag, n) in links:
+      citing = self.reverse[d or doc][tag]
+      citing.discard((doc, n))
+      if not citing:
+        del self.reverse[d or doc][tag]
+
+  def record(self, doc, entry, parsed):
+    """
+    Store the citations made by `doc`, given its parse and the mtime, size
+    and md5 hash of its source in `entry`.
+    """
+    links = [list(x) for x in links_of(parsed)]
+    old = self.docs.get(doc)
+    if old is not None:
+      if old["hash"] == entry["hash"] and old["links"] == links:
+        return
+      self._unlink(doc, old["links"])
+    self.docs[doc] = {"mtime": entry["mtime"], "size": entry["size"],
+                      "hash": entry["hash"], "links": links}
+    self._link(doc, links)
+    self.dirty = True
+
+  def remove(self, doc):
+    old = self.docs.pop(doc, None)
+    if old is not None:
+      self._unlink(doc, old["links"])
+      self.dirty = True
+
+  def refresh(self, docs, parse_config={}):
+    """
+    Bring the index up to date, given the map doc => entry (mtime, size and
+    md5 hash, see hypertex.build.documents) of every document in src_dir.
+    The documents whose source changed since they were recorded are parsed
+    again, and those that no longer exist are removed.
+    """
+    with instrument.phase("backlinks.refresh"):
+      for doc in list(self.docs):
+        if doc not in docs:
+          self.remove(doc)
+      parse_config = dict(parse_config, src_dir=self.src_dir)
+      for doc in sorted(docs):
+        old = self.docs.get(doc)
+        if old is not None and old["hash"] == docs[doc]["hash"]:
+          continue
+        instrument.count("backlinks.parses")
+        path = "%s/%s.xml" % (self.src_dir, doc)
+        with hypertex.parser.map_source(path) as htex:
+          parsed = hypertex.parser.parse(htex, parse_config)
+        self.record(doc, docs[doc], parsed)
+
+  def cited_by(self, doc, tag):
+    """
+    Return the sorted list of the pairs (doc, par number) of the pars which
+    cite the par with tag `tag` in `doc`.
+    """
+    return sorted(self.reverse.get(doc, {}).get(tag, ()))
+
+  def doc_backlinks(self, doc):
+    """
+    Return the map tag => sorted list of citing pairs (doc, par number) for
+    the cited tags of `doc`, where doc is "" for the pars of `doc` itself.
+    This is what the HTML renderer takes as its backlinks option.
+    """
+    return dict((tag, sorted((d if d != doc else "", n) for (d, n) in citing))
+      for (tag, citing) in self.reverse.get(doc, {}).items())
+
+def get_backlink_index(src_dir, cache_dir=None):
+  """
+  Return the backlink index of src_dir, which is shared by everything in the
+  process that uses the same src_dir and cache_dir.
+  """
+  src_dir = os.path.abspath(src_dir)
+  key = (src_dir, cache_dir)
+  if key not in _indices:
+    path = None
+    if cache_dir:
+      path = os.path.join(cache_dir, "backlinks.json")
+    _indices[key] = BacklinkIndex(src_dir, path)
+  return _indices[key]
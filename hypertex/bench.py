@@ -0,0 +1,551 @@
+import os
+import sys
+import json
+import codecs
+import time
+import random
+import shutil
+import tempfile
+import platform
+import subprocess
+from optparse import OptionParser
+
+import hypertex.parser
+import hypertex.render.html
+import hypertex.render.tex
+import hypertex.build
+from hypertex import nodes, incremental, search
+
+BLOCKS = ["p", "def", "rmk", "lem", "prp", "thm", "cor", "prf", "exm"]
+
+def generate_document(pars, inline=20, citations=True):
+  """
+  Generate a synthetic HyperTeX document with `pars` paragraphs, each
+  containing about `inline` inline tags.  Without `citations`, the <cite>
+  and <term> tags are left out.
+  """
+  out = ["<document><head><title>Synthetic</title>"
+         "<macro name=\"R\" value=\"\\mathbf{R}\" /></head><body>"]
+  for i in range(pars):
+    out.append("<par tag=\"p%d\"><def>" % i)
+    for j in range(inline):
+      k = j % 5
+      if k == 0:
+        out.append("A <d>thing %d</d> in $\\R^%d$, " % (j, j))
+      elif k == 1 and citations:
+        out.append("see <cite tag=\"p%d\">here</cite>, " % (i // 2))
+      elif k == 2:
+        out.append("<b>bold</b> and <i>italic</i>, ")
+      elif k == 3 and citations:
+        out.append("a <term tag=\"p0\">term</term>, ")
+      elif k == 4:
+        out.append("<frml>x_{%d} \\to y</frml> " % j)
+    out.append("</def></par>\n")
+  out.append("</body></document>")
+  return "".join(out)
+
+def generate_formula_document(pars, formulas=20, run=200):
+  """
+  Generate a document with `pars` paragraphs of `formulas` formulas each,
+  full of < and >, with some runs of about `run` characters of math without
+  any letters in them.
+  """
+  out = ["<document><head><title>Formulas</title></head><body>"]
+  digits = " + ".join(str(k % 10) for k in range(run // 4))
+  for i in range(pars):
+    out.append("<par tag=\"f%d\"><p>" % i)
+    for j in range(formulas):
+      k = j % 4
+      if k == 0:
+        out.append("$0 < x_{%d} < 1$ and $y>%d$, " % (j, j))
+      elif k == 1:
+        out.append("$\\langle a, b \\rangle > 0$, ")
+      elif k == 2:
+        out.append("<frml>%s = %d</frml> " % (digits, j))
+      elif k == 3:
+        out.append("$a < b+1$ but $c<=d$. ")
+    out.append("</p></par>\n")
+  out.append("</body></document>")
+  return "".join(out)
+
+def _time(f, *args):
+  "Return the best of three wall-clock times of f(*args), in seconds."
+  best = None
+  for _ in range(3):
+    start = time.time()
+    f(*args)
+    t = time.time() - start
+    if best is None or t < best:
+      best = t
+  return best
+
+def parse_scaling(sizes=(250, 500, 1000, 2000, 4000), inline=20):
+  """
+  Time hypertex.parser.parse on documents of increasing numbers of
+  paragraphs (without citations), and print the time per paragraph, which
+  should stay roughly constant if parsing is linear.
+  """
+  results = []
+  for n in sizes:
+    htex = generate_document(n, inline, citations=False)
+    t = _time(hypertex.parser.parse, htex, {"src_dir": "."})
+    results.append((n, t))
+    print "%6d pars  %8.3fs  %8.1fus/par" % (n, t, 1e6 * t / n)
+  return results
+
+def dense_citations(sizes=(500, 1000, 2000, 4000), inline=20):
+  """
+  Time hypertex.parser.parse on documents where every par cites other pars
+  of the same document several times.
+  """
+  results = []
+  for n in sizes:
+    htex = generate_document(n, inline, citations=True)
+    t = _time(hypertex.parser.parse, htex, {"src_dir": "."})
+    results.append((n, t))
+    print "%6d pars  %8.3fs  %8.1fus/par (with citations)" % (n, t,
+      1e6 * t / n)
+  return results
+
+def formula_heavy(sizes=(250, 500, 1000, 2000)):
+  """
+  Time the escaping of stray angle brackets and the whole parse on
+  formula-heavy documents of increasing numbers of paragraphs.
+  """
+  results = []
+  for n in sizes:
+    htex = generate_formula_document(n)
+    fix = _time(hypertex.parser._fix_angle_brackets, htex)
+    t = _time(hypertex.parser.parse, htex, {"src_dir": "."})
+    results.append((n, fix, t))
+    print "%6d pars  %6.1fMB  escape %8.4fs  parse %8.3fs" % (n,
+      len(htex) / 1e6, fix, t)
+  return results
+
+def parallel_build(processes=(1, 2, 4), docs=40, pars=100):
+  """
+  Time a full build of a generated collection with different numbers of
+  worker processes, and print the speedup over a single process.
+  """
+  tmp = tempfile.mkdtemp(prefix="hypertex-bench-")
+  results = []
+  try:
+    src_dir = os.path.join(tmp, "src")
+    generate_collection(src_dir, docs=docs, pars=pars)
+    for n in processes:
+      out_dir = os.path.join(tmp, "out%d" % n)
+      t = _time_once(lambda: hypertex.build.build(src_dir, out_dir,
+        ["html", "tex"], {"cache_dir": os.path.join(tmp, "cache%d" % n)},
+        processes=n))
+      results.append((n, t))
+      print "%2d processes  %8.3fs  %5.2fx" % (n, t, results[0][1] / t)
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+  return results
+
+def _in_child(f):
+  """
+  Run f in a child process, so that it starts from the memory use of this
+  one, and return the time it took and the peak RSS of the child in MB.
+  """
+  (r, w) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(r)
+    os.write(w, repr(_time_once(f)))
+    os._exit(0)
+  os.close(w)
+  t = float(os.read(r, 100))
+  os.close(r)
+  (_, _, usage) = os.wait4(pid, 0)
+  return (t, usage.ru_maxrss / 1024.0)
+
+def large_documents(sizes=(2, 8, 32)):
+  """
+  Compare parsing a formula heavy document of each size (in MB) from a
+  unicode string read with codecs, as bin/hypertex used to, and from the
+  memory-mapped file: time and peak RSS.
+  """
+  tmp = tempfile.mkdtemp(prefix="hypertex-bench-")
+  config = {"src_dir": tmp}
+  try:
+    par = len(generate_formula_document(1)) + 1
+    for size in sizes:
+      path = os.path.join(tmp, "large%d.xml" % size)
+      def write(path=path, size=size):
+        with open(path, "w") as f:
+          f.write(generate_formula_document(size * 1024 * 1024 / par))
+      _in_child(write)
+      def decoded(path=path):
+        htex = codecs.open(path, encoding="utf8", mode="r").read()
+        hypertex.parser.parse(htex, config)
+      def mapped(path=path):
+        with hypertex.parser.map_source(path) as htex:
+          hypertex.parser.parse(htex, config)
+      (t0, rss0) = _in_child(decoded)
+      (t1, rss1) = _in_child(mapped)
+      print "%3d MB  decoded %7.3fs %7.1f MB  mapped %7.3fs %7.1f MB" % (
+        size, t0, rss0, t1, rss1)
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+QUERIES = ["nested", "def:nested text", "block:thm compare", "formula:to",
+  "paragraph 7", "term:that see"]
+
+def search_queries(docs=200, pars=100):
+  """
+  Time indexing a generated collection of docs * pars pars for search, and
+  querying it.
+  """
+  tmp = tempfile.mkdtemp(prefix="hypertex-bench-")
+  try:
+    src_dir = os.path.join(tmp, "src")
+    generate_collection(src_dir, docs=docs, pars=pars)
+    start = time.time()
+    index = search.SearchIndex(src_dir)
+    index.refresh(hypertex.build.documents(src_dir))
+    print "indexed %d pars in %.3fs" % (len(index.pars), time.time() - start)
+    for query in QUERIES:
+      t = _time(index.search, query)
+      print "%-24s %5d results  %8.2fms" % (query,
+        len(index.search(query, None)), t * 1000)
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+def _deep_sizeof(x, seen=None):
+  "The memory taken by x and everything it references, in bytes."
+  if seen is None:
+    seen = set()
+  if id(x) in seen:
+    return 0
+  seen.add(id(x))
+  size = sys.getsizeof(x)
+  if isinstance(x, dict):
+    for (k, v) in x.items():
+      size += _deep_sizeof(k, seen) + _deep_sizeof(v, seen)
+  elif isinstance(x, (list, tuple)):
+    for v in x:
+      size += _deep_sizeof(v, seen)
+  elif isinstance(x, nodes.Node):
+    size += _deep_sizeof(x.content, seen) + _deep_sizeof(x.attrs, seen)
+  return size
+
+def node_representations(pars=2000, inline=20):
+  """
+  Compare the memory taken by the pars of a parsed document, and the time to
+  parse and render it, between dict nodes and hypertex.nodes.Node.
+  """
+  htex = generate_document(pars, inline, citations=False)
+  results = {}
+  for (name, use_nodes) in [("dict", False), ("Node", True)]:
+    config = {"src_dir": ".", "nodes": use_nodes}
+    parsed = hypertex.parser.parse(htex, config)
+    results[name] = {
+      "memory": _deep_sizeof(parsed["body"]["pars"]),
+      "parse":  _time(hypertex.parser.parse, htex, config),
+      "html":   _time(hypertex.render.html.render, parsed, {}),
+      "tex":    _time(hypertex.render.tex.render, parsed, {})}
+    print "%-4s  %6.1fMB  parse %.3fs  html %.3fs  tex %.3fs" % (name,
+      results[name]["memory"] / 1e6, results[name]["parse"],
+      results[name]["html"], results[name]["tex"])
+  return results
+
+def _nested(rng, depth, text):
+  "Wrap text in `depth` random inline tags."
+  for _ in range(depth):
+    tag = rng.choice(["b", "i", "u", "d", "sub", "sup"])
+    text = "<%s>%s</%s>" % (tag, text, tag)
+  return text
+
+def _macro_name(i):
+  "The name of the i-th generated macro: ma, ..., mz, mba, ... (only letters)."
+  name = ""
+  while True:
+    name = chr(ord("a") + i % 26) + name
+    i //= 26
+    if not i:
+      return "m" + name
+
+def _generate_par(rng, i, d, params):
+  pieces = ["Paragraph %d of document %d, with $x_%d < y$ and $a > b$. "
+    % (i, d, i)]
+  for _ in range(params["internal"]):
+    pieces.append("See <cite tag=\"t%d\">this</cite>. "
+      % rng.randrange(params["pars"]))
+  for _ in range(params["external"]):
+    pieces.append("Compare <term tag=\"doc%d/t%d\">that</term>. "
+      % (rng.randrange(params["docs"]), rng.randrange(params["pars"])))
+  if params["refs"]:
+    pieces.append("<cite ref=\"r%d\" post=\"p. %d\">ref</cite> "
+      % (rng.randrange(params["refs"]), i))
+  if params["macros"]:
+    pieces.append("<frml>\\%s{x} \\to y_{%d}</frml> "
+      % (_macro_name(rng.randrange(params["macros"])), i))
+  pieces.append(_nested(rng, params["depth"], "nested text"))
+  pieces.append(" <ul><li>one</li><li>two</li></ul>")
+  block = rng.choice(BLOCKS)
+  return "<par tag=\"t%d\"><%s>%s</%s></par>\n" % (i, block,
+    "".join(pieces), block)
+
+def generate_collection(out_dir, docs=20, pars=50, depth=2, internal=2,
+                        external=1, macros=10, refs=20, images=0, seed=0):
+  """
+  Write a synthetic collection to out_dir: `docs` documents doc0.xml, ...,
+  each with `pars` pars, plus macros.xml and refs.xml with the given numbers
+  of macros and references.  Each par has `internal` citations of pars of
+  its document, `external` citations of pars of other documents, one
+  reference, one formula and inline tags nested `depth` deep.  Each document
+  also has `images` formulas rendered as images, which use the macros too.
+  Returns the list of document names.
+  """
+  rng = random.Random(seed)
+  params = {"docs": docs, "pars": pars, "depth": depth, "internal": internal,
+            "external": external, "macros": macros, "refs": refs}
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+  with open(os.path.join(out_dir, "macros.xml"), "w") as f:
+    f.write("<macros>\n")
+    for i in range(macros):
+      f.write("<macro name=\"%s\" value=\"\\mathrm{M%d}\" />\n"
+        % (_macro_name(i), i))
+    f.write("</macros>\n")
+  with open(os.path.join(out_dir, "refs.xml"), "w") as f:
+    f.write("<refs>\n")
+    for i in range(refs):
+      f.write("<ref id=\"r%d\"><author>Author %d</author>"
+        "<title>Title %d</title><year>%d</year></ref>\n"
+        % (i, rng.randrange(1000), i, 1900 + i % 100))
+    f.write("</refs>\n")
+  names = []
+  for d in range(docs):
+    out = ["<document>\n<head>\n<title>Document %d</title>\n"
+           "<author>Author %d</author>\n<macros src=\"macros.xml\" />\n"
+           "<refs src=\"refs.xml\" />\n</head>\n<body>\n" % (d, d)]
+    for i in range(pars):
+      out.append(_generate_par(rng, i, d, params))
+    for i in range(images):
+      macro = ""
+      if macros:
+        macro = "\\%s " % _macro_name(rng.randrange(macros))
+      out.append("<par><p><frml img=\"1\">%s\\int_0^%d f_{%d}</frml></p>"
+        "</par>\n" % (macro, i, d))
+    out.append("</body>\n</document>\n")
+    name = "doc%d" % d
+    with open(os.path.join(out_dir, name + ".xml"), "w") as f:
+      f.write("".join(out))
+    names.append(name)
+  return names
+
+# the directory containing the hypertex package, and bin/hypertex
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _startup_time(args, repeat=5):
+  """
+  The best time of running the Python interpreter with the given arguments
+  in a new process, with this hypertex importable.  Measures what importing
+  hypertex costs on every run of bin/hypertex.
+  """
+  env = dict(os.environ, PYTHONPATH=ROOT)
+  devnull = open(os.devnull, "w")
+  try:
+    return min(_time_once(lambda: subprocess.call([sys.executable] + args,
+      env=env, stdout=devnull, stderr=devnull)) for i in range(repeat))
+  finally:
+    devnull.close()
+
+def _read(path):
+  return open(path, "r").read().decode("utf8")
+
+# stand-ins for pdflatex and convert, which write an empty page and image
+FAKE_TOOLS = {
+  "pdflatex": "#!/bin/sh\nfor a in \"$@\"; do case \"$a\" in\n"
+              "  -output-dir=*) dir=\"${a#-output-dir=}\";; *) tex=\"$a\";;\n"
+              "esac; done\necho %PDF > \"$dir/$(basename \"$tex\").pdf\"\n",
+  "convert":  "#!/bin/sh\nfor a in \"$@\"; do png=\"$a\"; done\n"
+              "echo PNG > \"$png\"\n"}
+
+def _fake_tools(bin_dir):
+  """
+  Write FAKE_TOOLS to bin_dir for the ones that aren't installed, and return
+  the PATH under which they are found.  With them, the formula image
+  benchmarks measure the image cache and the running of the tools rather
+  than TeX.
+  """
+  path = os.environ.get("PATH", "")
+  dirs = path.split(os.pathsep)
+  missing = [tool for tool in sorted(FAKE_TOOLS) if not any(
+    os.access(os.path.join(d, tool), os.X_OK) for d in dirs)]
+  if not missing:
+    return path
+  os.makedirs(bin_dir)
+  for tool in missing:
+    script = os.path.join(bin_dir, tool)
+    with open(script, "w") as f:
+      f.write(FAKE_TOOLS[tool])
+    os.chmod(script, 0755)
+  return os.pathsep.join([bin_dir, path])
+
+def run_suite(params={}, repeat=3):
+  """
+  Run the benchmarks on a collection generated with the given parameters
+  (see generate_collection) and return a dict name => best time in seconds.
+  The formula images are rendered with pdflatex and convert if they are
+  installed, and with FAKE_TOOLS otherwise.
+  """
+  tmp = tempfile.mkdtemp(prefix="hypertex-bench-")
+  results = {}
+  path = os.environ.get("PATH", "")
+  try:
+    os.environ["PATH"] = _fake_tools(os.path.join(tmp, "bin"))
+    src_dir = os.path.join(tmp, "src")
+    docs = generate_collection(src_dir, **params)
+    sources = [_read(os.path.join(src_dir, d + ".xml")) for d in docs]
+    config = {"src_dir": src_dir}
+
+    def parse_all(config=config):
+      return [hypertex.parser.parse(htex, config) for htex in sources]
+    results["parse"] = _time(parse_all)
+    parsed = parse_all()
+    cached = dict(config, cache_dir=os.path.join(tmp, "asts"), ast_cache=True)
+    parse_all(cached)
+    results["parse.ast_cache"] = _time(parse_all, cached)
+    results["render.html"] = _time(lambda:
+      [hypertex.render.html.render(p, {}) for p in parsed])
+    results["render.tex"] = _time(lambda:
+      [hypertex.render.tex.render(p, {}) for p in parsed])
+    def render_images(n):
+      config = {"img_dir": os.path.join(tmp, "img%d" % n)}
+      return lambda: [hypertex.render.html.render(p, config) for p in parsed]
+    cold = [render_images(n) for n in range(repeat)]
+    results["render.html.images.cold"] = min(_time_once(f) for f in cold)
+    results["render.html.images"] = _time(cold[0])
+    entries = hypertex.build.documents(src_dir, os.path.join(tmp, "none"))
+    def index_all():
+      index = search.SearchIndex(src_dir)
+      for (doc, p) in zip(docs, parsed):
+        index.record(doc, entries[doc], p)
+      return index
+    results["search.index"] = _time(index_all)
+    index = index_all()
+    results["search.query"] = _time(lambda: map(index.search, QUERIES))
+
+    def build(n):
+      out_dir = os.path.join(tmp, "out%d" % n)
+      cache_dir = os.path.join(tmp, "cache%d" % n)
+      return lambda: hypertex.build.build(src_dir, out_dir, ["html", "tex"],
+        {"cache_dir": cache_dir})
+    cold = [build(n) for n in range(repeat)]
+    results["build.cold"] = min(_time_once(f) for f in cold)
+    results["build.noop"] = _time(cold[0])
+    edited = os.path.join(src_dir, docs[0] + ".xml")
+    def touch():
+      with open(edited, "a") as f:
+        f.write("\n")
+      cold[0]()
+    results["build.edit"] = _time(touch)
+
+    htex = generate_document(2000, 20, citations=True)
+    results["parse.dense_citations"] = _time(hypertex.parser.parse, htex,
+      {"src_dir": src_dir})
+    # a preview of this document, where each update edits one par
+    preview = incremental.Document({"src_dir": src_dir}, {}, "html")
+    preview.update(htex)
+    edits = [htex.replace("thing 5<", "thing %d<" % k, 1) for k in range(4)]
+    results["incremental.update"] = _time(lambda: preview.update(edits.pop()))
+    htex = generate_formula_document(1000)
+    results["parse.formula_heavy"] = _time(hypertex.parser.parse, htex,
+      {"src_dir": src_dir})
+    large = os.path.join(tmp, "large.xml")
+    with open(large, "w") as f:
+      f.write(generate_formula_document(4000))
+    def parse_large():
+      with hypertex.parser.map_source(large) as htex:
+        hypertex.parser.parse(htex, {"src_dir": src_dir})
+    results["parse.large_file"] = _time(parse_large)
+
+    results["startup.python"] = _startup_time(["-c", "pass"])
+    results["startup.import"] = _startup_time(["-c", "import hypertex"])
+    script = os.path.join(ROOT, "bin", "hypertex")
+    if os.path.isfile(script):
+      # a small document, so that this is mostly the startup
+      small = os.path.join(src_dir, docs[-1] + ".xml")
+      results["startup.cli.tex"] = _startup_time([script, "-i", small,
+        "-f", "tex", "--srcdir", src_dir])
+  finally:
+    os.environ["PATH"] = path
+    shutil.rmtree(tmp, ignore_errors=True)
+  return results
+
+def _time_once(f):
+  start = time.time()
+  f()
+  return time.time() - start
+
+def compare(old, new, threshold=0.1):
+  """
+  Print the benchmarks in `new` next to those in `old` (both as returned by
+  run_suite), and return the names of those that got slower by more than
+  `threshold` (a fraction).
+  """
+  regressions = []
+  for name in sorted(new):
+    if name not in old:
+      print "%-24s %9.4fs" % (name, new[name])
+      continue
+    ratio = new[name] / old[name] if old[name] else 1.0
+    flag = ""
+    if ratio > 1 + threshold:
+      flag = "  REGRESSION"
+      regressions.append(name)
+    print "%-24s %9.4fs %9.4fs  %5.2fx%s" % (name, old[name], new[name],
+      ratio, flag)
+  return regressions
+
+SIZES = {
+  "small":  {"docs": 10, "pars": 20, "images": 2},
+  "medium": {"docs": 50, "pars": 50, "images": 2},
+  "large":  {"docs": 200, "pars": 100, "images": 2}}
+
+if __name__ == "__main__":
+  op = OptionParser(usage="python -m hypertex.bench [options]")
+  op.add_option("-s", "--size", dest="size", default="medium",
+    help="size of the generated collection (small, medium or large)")
+  op.add_option("-o", "--output", dest="output",
+    help="write the results as JSON to this file")
+  op.add_option("-c", "--compare", dest="compare",
+    help="compare with the results in this JSON file")
+  op.add_option("-t", "--threshold", dest="threshold", type="float",
+    default=0.1, help="slowdown counted as a regression (default 0.1)")
+  op.add_option("--studies", dest="studies", action="store_true",
+    default=False,
+    help="also print the parse scaling, formula, node representation, "
+         "parallel build, search and large document studies")
+  (options, args) = op.parse_args()
+  if options.size not in SIZES:
+    op.error("Please choose a valid size (small, medium or large).")
+
+  # keep error messages about the synthetic documents out of the way
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+  try:
+    results = run_suite(SIZES[options.size])
+  finally:
+    sys.stdout = stdout
+  if options.compare:
+    old = json.load(open(options.compare, "r"))
+    regressions = compare(old["results"], results, options.threshold)
+  else:
+    regressions = compare({}, results)
+  if options.output:
+    json.dump({"size": options.size, "python": platform.python_version(),
+               "time": time.time(), "results": results},
+      open(options.output, "w"), indent=2, sort_keys=True)
+  if options.studies:
+    parse_scaling()
+    dense_citations()
+    formula_heavy()
+    node_representations()
+    parallel_build()
+    search_queries()
+    large_documents()
+  sys.exit(1 if regressions else 0)
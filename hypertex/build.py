@@ -0,0 +1,325 @@
+# no __name__ here: the functions run by the worker processes of parallel
+# builds are pickled by module name
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+import multiprocessing
+
+import hypertex.parser
+from hypertex import index, backlinks, search
+from hypertex.render import images, renderer
+
+STATE_VERSION = 1
+
+def _is_document(src):
+  "Whether src is a HyperTeX document (rather than e.g. a macro file)."
+  return re.match(r"\s*(<\?.*?\?>\s*)?(<!--.*?-->\s*)*<document[\s>]", src,
+    re.S) is not None
+
+def _file_entry(path, old=None):
+  """
+  Return a dict with the mtime, size and md5 hash of the file at path, or
+  None if it doesn't exist.  The hash in `old` is reused if the mtime and size
+  are unchanged.
+  """
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  if old and old["mtime"] == st.st_mtime and old["size"] == st.st_size:
+    return old
+  try:
+    digest = hashlib.md5(open(path, "rb").read()).hexdigest()
+  except IOError:
+    return None
+  return {"mtime": st.st_mtime, "size": st.st_size, "hash": digest}
+
+def _changed(path, old):
+  new = _file_entry(path, old)
+  if old is None:
+    return new is not None
+  return new is None or new["hash"] != old["hash"]
+
+def _load_state(path):
+  try:
+    state = json.load(open(path, "r"))
+  except (IOError, ValueError):
+    return {"docs": {}, "other": {}}
+  if state.get("version") != STATE_VERSION:
+    return {"docs": {}, "other": {}}
+  return state
+
+def _save_state(state, path):
+  dirname = os.path.dirname(path)
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  state["version"] = STATE_VERSION
+  (f, tmppath) = tempfile.mkstemp(dir=dirname)
+  with os.fdopen(f, "w") as out:
+    json.dump(state, out)
+  os.rename(tmppath, path)
+
+def _scan(src_dir, state):
+  """
+  Return the maps name => entry (see _file_entry) of the documents and of
+  the other files (e.g. macro files) in src_dir.  Files whose hash is the
+  same as in the build state aren't read again to tell which they are.
+  """
+  docs = {}
+  other = {}
+  for fname in sorted(os.listdir(src_dir)):
+    if not fname.endswith(".xml"):
+      continue
+    doc = fname[:-len(".xml")]
+    path = "%s/%s" % (src_dir, fname)
+    old = state["docs"].get(doc)
+    entry = _file_entry(path, old and old["source"] or state["other"].get(doc))
+    if entry is None:
+      continue
+    if doc in state["docs"] and entry["hash"] == old["source"]["hash"]:
+      docs[doc] = entry
+    elif doc in state["other"] and entry["hash"] == state["other"][doc]["hash"]:
+      other[doc] = entry
+    else:
+      with hypertex.parser.map_source(path) as src:
+        if _is_document(src):
+          docs[doc] = entry
+        else:
+          other[doc] = entry
+  return (docs, other)
+
+def documents(src_dir, cache_dir=None):
+  """
+  Return the map doc => entry (mtime, size and md5 hash of the source) of
+  the documents in src_dir, using the state of the last build if there is
+  one in cache_dir.
+  """
+  src_dir = os.path.abspath(src_dir)
+  cache_dir = cache_dir or os.path.join(src_dir, ".hypertex")
+  return _scan(src_dir, _load_state(os.path.join(cache_dir, "build.json")))[0]
+
+def _output_path(out_dir, doc, format):
+  return "%s/%s.%s" % (out_dir, doc, format)
+
+def _needs_rebuild(doc, entry, old, formats, tag_index, out_dir, cited_by):
+  "Decide whether the outputs of `doc` are out of date."
+  if old is None or old["source"]["hash"] != entry["hash"]:
+    return True
+  if old.get("cited_by") != cited_by:
+    return True
+  for format in formats:
+    if not os.path.isfile(_output_path(out_dir, doc, format)):
+      return True
+  for (path, f) in old["files"].items():
+    if _changed(path, f):
+      return True
+  for (d, tag, par) in old["citations"]:
+    if (tag_index.lookup(d, tag) or 0) != par:
+      return True
+  return False
+
+def _write(path, output):
+  (f, tmppath) = tempfile.mkstemp(dir=os.path.dirname(path))
+  with os.fdopen(f, "w") as out:
+    out.write(output.encode("utf8", "ignore"))
+  os.rename(tmppath, path)
+
+def _build_doc(doc, src_dir, out_dir, formats, parse_config, render_configs):
+  """
+  Parse a document and write its outputs.  Returns what the build state
+  needs to know about it: the macro and reference files it uses, its
+  external citations and its tags, along with the counts of
+  hypertex.parser.loaded_files_stats() made while building it.
+  """
+  before = hypertex.parser.loaded_files_stats()
+  path = "%s/%s.xml" % (src_dir, doc)
+  with hypertex.parser.map_source(path) as htex:
+    parsed = hypertex.parser.parse(htex, parse_config)
+  for format in formats:
+    output = renderer(format).render(parsed, render_configs.get(format, {}))
+    _write(_output_path(out_dir, doc, format), output)
+  files = {}
+  for f in parsed["deps"]["files"]:
+    files[f] = _file_entry(f)
+  after = hypertex.parser.loaded_files_stats()
+  return {
+    "files":        files,
+    "citations":    parsed["deps"]["citations"],
+    "tags":         parsed["body"]["tags"],
+    "loaded_files": dict((k, after[k] - before[k]) for k in after)}
+
+# the tag index of the worker processes of a parallel build
+_worker_tag_index = None
+
+def _init_worker(src_dir, tag_maps):
+  """
+  Set up a worker process with the tag maps of all the documents, which the
+  main process has brought up to date, so that workers never read a
+  document other than the ones they build.
+  """
+  global _worker_tag_index
+  _worker_tag_index = index.TagIndex(src_dir)
+  _worker_tag_index.docs = tag_maps
+  _worker_tag_index.checked = set(tag_maps)
+
+def _build_doc_in_worker(args):
+  (doc, src_dir, out_dir, formats, parse_config, render_configs) = args
+  parse_config = dict(parse_config, tag_index=_worker_tag_index)
+  return _build_doc(doc, src_dir, out_dir, formats, parse_config,
+    render_configs)
+
+def _build_docs(todo, docs, src_dir, out_dir, formats, parse_config,
+                render_configs, processes):
+  """
+  Build the documents in todo, on `processes` worker processes if there is
+  more than one, and return the list of results of _build_doc.  docs maps
+  every document of src_dir to the entry of its source, and render_configs
+  maps each document to its render configs.  The loads of macro and
+  reference files made by the workers are added to the counts of
+  hypertex.parser.loaded_files_stats() in this process.
+  """
+  tag_index = parse_config["tag_index"]
+  if processes <= 1 or len(todo) <= 1:
+    results = []
+    for doc in todo:
+      results.append(_build_doc(doc, src_dir, out_dir, formats, parse_config,
+        render_configs[doc]))
+      # so that the documents built next don't have to read it again
+      tag_index.record(doc, docs[doc], results[-1]["tags"])
+    return results
+  for doc in docs:
+    tag_index.tags(doc)
+  worker_config = dict(parse_config)
+  del worker_config["tag_index"]
+  pool = multiprocessing.Pool(min(processes, len(todo)), _init_worker,
+    (src_dir, tag_index.docs))
+  try:
+    results = pool.map(_build_doc_in_worker, [(doc, src_dir, out_dir, formats,
+      worker_config, render_configs[doc]) for doc in todo], 1)
+  finally:
+    pool.close()
+    pool.join()
+  for result in results:
+    hypertex.parser.add_loaded_files_stats(result["loaded_files"])
+  return results
+
+def build(src_dir, out_dir, formats=("html",), parse_config={},
+          render_configs={}, force=False, processes=1, with_backlinks=False,
+          with_search=False):
+  """
+  Render every document in src_dir into out_dir, in each of the given
+  formats.  Unless `force` is set, a document is only rendered again if its
+  source, one of its macro or reference files, or the number of a par it
+  cites has changed since the last build.  The dependency graph is kept in
+  CACHE_DIR/build.json.  Returns the list of documents that were rendered.
+
+  With processes > 1, the documents are parsed and rendered on that many
+  worker processes.  The main process first brings the tag index up to date
+  and hands it to the workers, so that the outputs are the same whatever the
+  number of processes.
+
+  With with_backlinks, the backlink index of src_dir (see
+  hypertex.backlinks) is brought up to date first, and each par of the HTML
+  outputs lists the pars citing it.  A document is then also rendered again
+  when the pars citing it change.
+
+  With with_search, the search index of src_dir (see hypertex.search) is
+  brought up to date after the documents are built, and exported to
+  OUT_DIR/search.json for searching on the client side.
+  """
+  src_dir = os.path.abspath(src_dir)
+  cache_dir = parse_config.get("cache_dir") or os.path.join(src_dir, ".hypertex")
+  state_path = os.path.join(cache_dir, "build.json")
+  state = _load_state(state_path)
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+
+  tag_index = index.get_tag_index(src_dir, cache_dir)
+  tag_index.begin_run()
+  parse_config = dict(parse_config,
+    src_dir=src_dir, cache_dir=cache_dir, tag_index=tag_index)
+
+  (docs, other) = _scan(src_dir, state)
+
+  backlink_index = None
+  if with_backlinks:
+    backlink_index = backlinks.get_backlink_index(src_dir, cache_dir)
+    backlink_index.refresh(docs, parse_config)
+  cited_by = {}
+  doc_render_configs = {}
+  for doc in docs:
+    cited_by[doc] = None
+    doc_render_configs[doc] = render_configs
+    if backlink_index is not None:
+      cited_by[doc] = dict((tag, [list(x) for x in citing]) for (tag, citing)
+        in backlink_index.doc_backlinks(doc).items())
+      doc_render_configs[doc] = dict(render_configs,
+        html=dict(render_configs.get("html", {}), backlinks=cited_by[doc]))
+
+  built = []
+  new_state = {"docs": {}, "other": other}
+  for doc in sorted(docs):
+    entry = docs[doc]
+    old = state["docs"].get(doc)
+    if not force and not _needs_rebuild(doc, entry, old, formats, tag_index,
+        out_dir, cited_by[doc]):
+      new_state["docs"][doc] = dict(old, source=entry)
+      continue
+    built.append(doc)
+
+  results = _build_docs(built, docs, src_dir, out_dir, formats, parse_config,
+    doc_render_configs, processes)
+  for (doc, result) in zip(built, results):
+    new_state["docs"][doc] = {
+      "source":    docs[doc],
+      "files":     result["files"],
+      "citations": result["citations"]}
+    if cited_by[doc] is not None:
+      new_state["docs"][doc]["cited_by"] = cited_by[doc]
+
+  # remove the outputs of documents that no longer exist
+  for doc in state["docs"]:
+    if doc not in docs:
+      for format in formats:
+        path = _output_path(out_dir, doc, format)
+        if os.path.isfile(path):
+          os.remove(path)
+
+  _save_state(new_state, state_path)
+  if backlink_index is not None:
+    backlink_index.save()
+  if with_search:
+    search_index = search.get_search_index(src_dir, cache_dir)
+    search_index.refresh(docs, parse_config)
+    export_path = os.path.join(out_dir, "search.json")
+    if search_index.dirty or not os.path.isfile(export_path):
+      search_index.export(export_path)
+    search_index.save()
+  tag_index.save()
+  return built
+
+def gc_images(src_dir, img_dir, parse_config={}):
+  """
+  Delete the formula images in img_dir that are not used by any document in
+  src_dir.  Returns the names of the deleted files.
+  """
+  src_dir = os.path.abspath(src_dir)
+  parse_config = dict(parse_config, src_dir=src_dir)
+  keep = set()
+  for fname in sorted(os.listdir(src_dir)):
+    if not fname.endswith(".xml"):
+      continue
+    with hypertex.parser.map_source("%s/%s" % (src_dir, fname)) as htex:
+      if not _is_document(htex):
+        continue
+      parsed = hypertex.parser.parse(htex, parse_config)
+    for (formula, macros) in renderer("html").image_formulas(parsed):
+      keep.add(images.formula_filename(formula, macros))
+  cache = images.get_cache(img_dir)
+  removed = cache.gc(keep)
+  cache.save()
+  index.save_tag_indices()
+  return removed
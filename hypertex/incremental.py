@@ -0,0 +1,145 @@
+__name__ = "incremental"
+
+from lxml import etree
+
+import hypertex.parser
+from hypertex import instrument
+from hypertex.constants import PAR_TAGS
+from hypertex.render import renderer
+from hypertex.parser import (_fix_angle_brackets, _parse_head, _parse_node,
+  _parse_partag, _make_node, _register_par_tags,
+  _resolve_internal_citations_in_node, _register_external_citations,
+  _number_cited_refs, _register_error, _head_files)
+
+# format => template of the whole document
+TEMPLATES = {"html": "template.html",
+             "tex":  "template.tex"}
+
+class Document(object):
+  """
+  A document which is parsed and rendered again every time its source
+  changes (e.g. for a preview), redoing as little work as possible.  Each
+  par is only parsed and rendered again if its source changed, or if one of
+  the pars, references or other documents it cites got a different number;
+  everything is redone if the head changes.
+
+    doc = Document(parse_config, render_config, "html")
+    result = doc.update(htex)
+    # result["parsed"], result["output"], result["changed"]
+  """
+
+  def __init__(self, parse_config={}, render_config={}, format="html"):
+    self.parse_config = hypertex.parser._make_config(parse_config)
+    self.renderer = renderer(format)
+    self.template = TEMPLATES[format]
+    self.render_config = self.renderer._make_config(render_config)
+    self.head = None
+    # signature of a par => (parsed par, rendered content), for the pars of
+    # the last version
+    self.pars = {}
+    # (type, tags, rendered content) of each par of the last version
+    self.rendered = []
+
+  def _signature(self, element, tag_map, refs):
+    """
+    Everything that the parse and rendering of a par depend on, besides the
+    head: its source, and the numbers of what it cites.
+    """
+    numbers = []
+    for x in element.iter("cite", "term"):
+      tag = x.attrib.get("tag")
+      if tag:
+        (doc, par) = _parse_partag(tag)
+        if doc:
+          numbers.append(self.parse_config["tag_index"].lookup(doc, par))
+        else:
+          numbers.append(tag_map.get(par))
+      elif x.tag == "cite" and x.attrib.get("ref"):
+        numbers.append(refs.get(x.attrib.get("ref"), {}).get("key"))
+    return (etree.tostring(element, with_tail=False), tuple(numbers))
+
+  def _parse_par(self, element, tag_map):
+    p = _make_node({
+      "type":    element.tag,
+      "content": [_parse_node(element, self.parse_config)],
+      "tags":    element.attrib.get("tag", "").split(";")}, self.parse_config)
+    return _resolve_internal_citations_in_node(p, {"body": {"tags": tag_map}},
+      self.parse_config)
+
+  def update(self, htex):
+    """
+    Parse and render a new version of the source.  Returns a dict with the
+    parsed document, the output, and the sorted list of the numbers of the
+    pars whose rendering changed ("changed"), which includes the numbers
+    past the end of the document of the pars that were removed.
+    """
+    config = self.parse_config
+    config["tag_index"].begin_run()
+    with instrument.phase("incremental.update"):
+      root = etree.fromstring(_fix_angle_brackets(htex))
+      parsed = {}
+      head = None
+      elements = []
+      for element in root:
+        if element.tag == "head":
+          head = etree.tostring(element, with_tail=False)
+          parsed.update(_parse_head(element, config))
+        elif element.tag == "body":
+          elements = [x for x in element if x.tag in PAR_TAGS]
+      if self.head != (head, parsed):
+        # the macros or references may have changed
+        self.pars = {}
+      self.head = (head, dict(parsed))
+
+      tag_map = {}
+      for (n, element) in enumerate(elements):
+        _register_par_tags(tag_map,
+          element.attrib.get("tag", "").split(";"), n + 1)
+
+      cited_ref_ids = set()
+      for element in elements:
+        for x in element.iter("cite"):
+          rid = x.attrib.get("ref")
+          if rid and not x.attrib.get("tag"):
+            if parsed["refs"].get(rid):
+              cited_ref_ids.add(rid)
+            else:
+              _register_error("External reference not found: %s" % rid)
+      _number_cited_refs(parsed, cited_ref_ids)
+
+      pars = {}
+      parsed_pars = []
+      contents = []
+      for element in elements:
+        sig = self._signature(element, tag_map, parsed["refs"])
+        if sig in self.pars:
+          (p, content) = self.pars[sig]
+          instrument.count("incremental.reused")
+        else:
+          p = self._parse_par(element, tag_map)
+          content = self.renderer._render_par(p, parsed, self.render_config)
+          instrument.count("incremental.rendered")
+        pars[sig] = (p, content)
+        parsed_pars.append(p)
+        contents.append(content)
+      self.pars = pars
+
+      parsed["body"] = {"pars": parsed_pars, "tags": tag_map}
+      citations = set()
+      for p in parsed_pars:
+        _register_external_citations(p, citations)
+      parsed["deps"] = {
+        "files":     _head_files(root, config),
+        "citations": sorted(citations)}
+
+      template = self.renderer._template(self.template)
+      output = template.render(self.renderer._template_vars(parsed,
+        [dict(p, content=c) for (p, c) in zip(parsed_pars, contents)]))
+
+      rendered = [(p.get("type"), p.get("tags"), c)
+        for (p, c) in zip(parsed_pars, contents)]
+      changed = [n + 1 for n in range(max(len(rendered), len(self.rendered)))
+        if n >= len(rendered) or n >= len(self.rendered) or
+           rendered[n] != self.rendered[n]]
+      self.rendered = rendered
+    return {"parsed": parsed, "output": output, "changed": changed}
@@ -0,0 +1,177 @@
+__name__ = "index"
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from lxml import etree
+
+import hypertex.parser
+from hypertex import instrument
+from hypertex.constants import PAR_TAGS
+
+INDEX_VERSION = 1
+
+_indices = {}
+
+def _read_tag_map(src):
+  """
+  Read the map tag => par number out of the source of a document (as bytes),
+  without doing a full parse.  The numbering agrees with the one made by
+  parse().
+  """
+  root = hypertex.parser._read_xml(src)
+  body = None
+  for element in root:
+    if element.tag == "body":
+      body = element
+  tags = {}
+  if body is None:
+    return tags
+  n = 0
+  for element in body:
+    if element.tag in PAR_TAGS:
+      n += 1
+      for tag in element.attrib.get("tag", "").split(";"):
+        tags.setdefault(tag, n)
+  return tags
+
+class TagIndex(object):
+  """
+  A map document => tag => par number for all the documents in src_dir.
+
+  Entries are checked against the mtime and size of the source file (and,
+  if these changed, its md5 hash) the first time a document is looked up
+  during a run; call begin_run() to have them checked again.  If a path is
+  given, the index is loaded from and saved to that file.  Safe to use from
+  several threads.
+  """
+
+  def __init__(self, src_dir, path=None):
+    self.src_dir = src_dir
+    self.path = path
+    self.docs = {}
+    self.checked = set()
+    self.dirty = False
+    self.lock = threading.RLock()
+    if path:
+      self._load()
+
+  def _load(self):
+    try:
+      data = json.load(open(self.path, "r"))
+    except (IOError, ValueError):
+      return
+    if data.get("version") == INDEX_VERSION:
+      self.docs = data.get("docs", {})
+
+  def save(self):
+    with self.lock:
+      if not self.path or not self.dirty:
+        return
+      dirname = os.path.dirname(self.path)
+      if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+      (f, tmppath) = tempfile.mkstemp(dir=dirname)
+      with os.fdopen(f, "w") as out:
+        json.dump({"version": INDEX_VERSION, "docs": self.docs}, out)
+      os.rename(tmppath, self.path)
+      self.dirty = False
+
+  def begin_run(self):
+    self.checked = set()
+
+  def doc_path(self, doc):
+    return "%s/%s.xml" % (self.src_dir, doc)
+
+  def _refresh(self, doc):
+    fpath = self.doc_path(doc)
+    entry = self.docs.get(doc)
+    try:
+      st = os.stat(fpath)
+    except OSError:
+      if entry is not None:
+        del self.docs[doc]
+        self.dirty = True
+      return
+    if entry and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+      return
+    # read rather than mapped, since the server looks documents up while
+    # they are being edited (see hypertex.server.Renderer._load)
+    try:
+      src = open(fpath, "rb").read()
+    except IOError:
+      return
+    digest = hashlib.md5(src).hexdigest()
+    if not entry or entry["hash"] != digest:
+      instrument.count("tag_index.scans")
+      try:
+        tags = _read_tag_map(src)
+      except etree.XMLSyntaxError:
+        tags = None
+      entry = {"hash": digest, "tags": tags}
+    entry["mtime"] = st.st_mtime
+    entry["size"] = st.st_size
+    self.docs[doc] = entry
+    self.dirty = True
+
+  def tags(self, doc):
+    """
+    Return the map tag => par number of the document `doc`, or None if it
+    does not exist or could not be read.
+    """
+    with self.lock:
+      if doc not in self.checked:
+        with instrument.phase("tag_index.refresh"):
+          self._refresh(doc)
+        self.checked.add(doc)
+      entry = self.docs.get(doc)
+    if entry is None:
+      return None
+    return entry["tags"]
+
+  def record(self, doc, entry, tags):
+    """
+    Store the tags of `doc` found by a full parse of its source, whose mtime,
+    size and md5 hash are given in `entry`, so that the document doesn't have
+    to be scanned again during this run.
+    """
+    with self.lock:
+      if doc in self.checked and self.docs.get(doc, {}).get("hash") == \
+          entry["hash"]:
+        return
+      self.docs[doc] = {"mtime": entry["mtime"], "size": entry["size"],
+                        "hash": entry["hash"], "tags": tags}
+      self.checked.add(doc)
+      self.dirty = True
+
+  def lookup(self, doc, tag):
+    "Return the number of the par with tag `tag` in `doc`, or None."
+    tags = self.tags(doc)
+    if tags is None:
+      return None
+    return tags.get(tag)
+
+def save_tag_indices():
+  """
+  Save the tag indices of this process which changed.  Call this at the end
+  of a run rather than after each parse, which would write the whole index
+  every time.
+  """
+  for tag_index in _indices.values():
+    tag_index.save()
+
+def get_tag_index(src_dir, cache_dir=None):
+  """
+  Return the tag index of src_dir, which is shared by everything in the
+  process that uses the same src_dir and cache_dir.
+  """
+  src_dir = os.path.abspath(src_dir)
+  key = (src_dir, cache_dir)
+  if key not in _indices:
+    path = None
+    if cache_dir:
+      path = os.path.join(cache_dir, "tags.json")
+    _indices[key] = TagIndex(src_dir, path)
+  return _indices[key]
@@ -0,0 +1,133 @@
+__name__ = "instrument"
+
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# functions that receive every event; see add_listener
+_listeners = []
+
+def add_listener(callback):
+  """
+  Call callback(event) for every event from now on.  An event is a dict with
+  a "kind" ("phase" or "count"), a "name" and a "thread" id.  Phases also
+  have a "start" time and a "duration" (both in seconds), and counts a
+  "value".  Listeners may be called from several threads at once.
+  """
+  _listeners.append(callback)
+
+def remove_listener(callback):
+  _listeners.remove(callback)
+
+def _emit(event):
+  for callback in list(_listeners):
+    callback(event)
+
+@contextmanager
+def phase(name):
+  "Record the time spent in the body of the with statement as a phase."
+  if not _listeners:
+    yield
+    return
+  start = time.time()
+  try:
+    yield
+  finally:
+    _emit({"kind": "phase", "name": name, "start": start,
+           "duration": time.time() - start,
+           "thread": threading.current_thread().ident})
+
+def count(name, value=1):
+  "Add value to the counter name."
+  if _listeners:
+    _emit({"kind": "count", "name": name, "value": value,
+           "thread": threading.current_thread().ident})
+
+class Profile(object):
+  """
+  A listener that adds up the events, and summarizes them or writes them
+  out as JSON or in the Chrome trace format (chrome://tracing).  Use it as
+
+    profile = Profile()
+    add_listener(profile)
+    ...
+    remove_listener(profile)
+    print profile.summary()
+
+  Only the last max_events phases are kept for the trace, so that a
+  long-running process (such as the server) doesn't keep them all; the
+  totals count every event.
+  """
+
+  def __init__(self, max_events=100000):
+    self.lock = threading.Lock()
+    # name => {"calls", "time"}, and name => value
+    self.phases = {}
+    self.counters = {}
+    self.events = deque(maxlen=max_events)
+    self.dropped = 0
+    self.created = time.time()
+
+  def __call__(self, event):
+    with self.lock:
+      if event["kind"] == "phase":
+        p = self.phases.setdefault(event["name"], {"calls": 0, "time": 0.0})
+        p["calls"] += 1
+        p["time"] += event["duration"]
+        if len(self.events) == self.events.maxlen:
+          self.dropped += 1
+        self.events.append(event)
+      else:
+        self.counters[event["name"]] = self.counters.get(event["name"], 0) + \
+          event["value"]
+
+  def totals(self):
+    """
+    Return (phases, counters), where phases maps the name of each phase to
+    a dict with its number of calls and total time, and counters maps the
+    name of each counter to its value.
+    """
+    with self.lock:
+      return (dict((name, dict(p)) for (name, p) in self.phases.items()),
+              dict(self.counters))
+
+  def summary(self):
+    (phases, counters) = self.totals()
+    lines = ["%-32s %8s %10s %10s" % ("phase", "calls", "total", "mean")]
+    for (name, p) in sorted(phases.items(), key=lambda x: -x[1]["time"]):
+      lines.append("%-32s %8d %9.3fs %9.2fms" % (name, p["calls"], p["time"],
+        1000 * p["time"] / p["calls"]))
+    if counters:
+      lines.append("")
+      lines.append("%-32s %8s" % ("counter", "value"))
+      for (name, value) in sorted(counters.items()):
+        lines.append("%-32s %8d" % (name, value))
+    return "\n".join(lines)
+
+  def to_json(self):
+    (phases, counters) = self.totals()
+    return {"phases": phases, "counters": counters}
+
+  def to_chrome_trace(self):
+    "The trace of the phases kept, with the number of older ones dropped."
+    trace = []
+    with self.lock:
+      events = list(self.events)
+      dropped = self.dropped
+    for e in events:
+      trace.append({"name": e["name"], "ph": "X", "pid": 0,
+        "tid": e["thread"], "ts": 1e6 * (e["start"] - self.created),
+        "dur": 1e6 * e["duration"]})
+    return {"traceEvents": trace, "displayTimeUnit": "ms",
+            "otherData": {"dropped_events": dropped}}
+
+  def write(self, path, format="json"):
+    "Write the profile to path, as JSON totals or as a Chrome trace."
+    if format == "chrome":
+      data = self.to_chrome_trace()
+    else:
+      data = self.to_json()
+    with open(path, "w") as f:
+      json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,113 @@
+from hypertex.constants import BLOCK_TAGS
+
+# the kinds of nodes, numbered by their position in this list; kind 0 is for
+# nodes without a type (e.g. the content of a par)
+KIND_NAMES = [None, "par"] + BLOCK_TAGS + [
+  "bold", "italic", "underline", "definition", "citation",
+  "external_citation", "term", "formula", "ord_list", "unord_list",
+  "list_item", "subscript", "superscript"]
+KINDS = dict((name, i) for (i, name) in enumerate(KIND_NAMES))
+
+class Node(object):
+  """
+  A compact node of a parsed document.  With the config option
+  {"nodes": True}, hypertex.parser.parse builds these instead of dicts
+  {"type": ..., "content": [...], ...}.  They support the parts of the dict
+  interface used by the renderers (get, [], keys, update), and as_dict()
+  gives back the dict representation.
+  """
+
+  __slots__ = ("kind", "content", "attrs")
+
+  def __init__(self, kind, content, attrs=None):
+    self.kind = kind
+    self.content = content
+    self.attrs = attrs
+
+  def get(self, key, default=None):
+    if key == "type":
+      return KIND_NAMES[self.kind] or default
+    if key == "content":
+      return self.content
+    if self.attrs is None:
+      return default
+    return self.attrs.get(key, default)
+
+  def __getitem__(self, key):
+    if key == "type":
+      if not self.kind:
+        raise KeyError(key)
+      return KIND_NAMES[self.kind]
+    if key == "content":
+      return self.content
+    if self.attrs is None:
+      raise KeyError(key)
+    return self.attrs[key]
+
+  def __setitem__(self, key, value):
+    if key == "type":
+      self.kind = KINDS[value]
+    elif key == "content":
+      self.content = value
+    else:
+      if self.attrs is None:
+        self.attrs = {}
+      self.attrs[key] = value
+
+  def __contains__(self, key):
+    return key in self.keys()
+
+  def keys(self):
+    keys = ["content"]
+    if self.kind:
+      keys.append("type")
+    if self.attrs:
+      keys.extend(self.attrs.keys())
+    return keys
+
+  def update(self, d):
+    for (k, v) in d.items():
+      self[k] = v
+
+  def as_dict(self):
+    "Return the dict representation of this node and its descendants."
+    d = dict(self.attrs or {})
+    if self.kind:
+      d["type"] = KIND_NAMES[self.kind]
+    d["content"] = [x.as_dict() if isinstance(x, Node) else x
+      for x in self.content]
+    return d
+
+  def __getstate__(self):
+    return (self.kind, self.content, self.attrs)
+
+  def __setstate__(self, state):
+    (self.kind, self.content, self.attrs) = state
+
+  def __repr__(self):
+    return "Node(%r, %r, %r)" % (KIND_NAMES[self.kind], self.content,
+      self.attrs)
+
+def from_dict(d):
+  """
+  Make a Node out of a dict node.  The children in its content are kept as
+  they are.
+  """
+  attrs = None
+  for (k, v) in d.items():
+    if k != "type" and k != "content":
+      if attrs is None:
+        attrs = {}
+      attrs[k] = v
+  return Node(KINDS[d.get("type")], d.get("content", []), attrs)
+
+def as_dict(node):
+  "Return the dict representation of a node, whichever form it is in."
+  if isinstance(node, Node):
+    return node.as_dict()
+  return node
+
+def pars_as_dicts(parsed):
+  "Return a copy of a parsed document whose pars are all dicts."
+  body = dict(parsed["body"], pars=[as_dict(p) for p in parsed["body"]["pars"]])
+  return dict(parsed, body=body)
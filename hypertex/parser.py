@@ -1,17 +1,84 @@
 __name__ = "parser"
 
 import os
+import mmap
 from codecs import open
+from contextlib import contextmanager
 from functools import reduce
 import re
+import hashlib
+import tempfile
+import threading
+import cPickle
 from lxml import etree
 
-from hypertex import render
+from hypertex import render, index, nodes, instrument
 from hypertex.constants import PAR_TAGS, BLOCK_TAGS, INLINE_TAGS
-from hypertex.util import dict_merge
+from hypertex.util import dict_merge, FrozenDict
+
+# bump this whenever the output of parse() changes, so that the parsed
+# documents cached on disk are not used anymore
+PARSER_VERSION = 2
+
+# path => ((mtime, size), contents) for the macro and reference files loaded
+# so far in this process
+_loaded_files = {}
+_loaded_files_lock = threading.Lock()
+_loaded_files_stats = {"hits": 0, "misses": 0}
+
+# the errors reported by the parse running in each thread, if it is kept in
+# the AST cache
+_errors = threading.local()
 
 def _register_error(message):
   print "Error: %s" % message
+  log = getattr(_errors, "log", None)
+  if log is not None:
+    log.append(message)
+
+def _load_file(fpath, read):
+  """
+  Return read(root), where root is the root element of the XML file at
+  fpath.  The result is kept for the rest of the process, and reused as long
+  as the mtime and size of the file don't change, so it should be immutable.
+  """
+  st = os.stat(fpath)
+  key = (st.st_mtime, st.st_size)
+  with _loaded_files_lock:
+    cached = _loaded_files.get(fpath)
+    if cached is not None and cached[0] == key:
+      _loaded_files_stats["hits"] += 1
+      instrument.count("loaded_files.hits")
+      return cached[1]
+  src = open(fpath, "r").read()
+  contents = read(etree.fromstring(src))
+  with _loaded_files_lock:
+    _loaded_files[fpath] = (key, contents)
+    _loaded_files_stats["misses"] += 1
+  instrument.count("loaded_files.misses")
+  return contents
+
+def loaded_files_stats():
+  """
+  Return the number of loads of macro and reference files that were saved
+  by reusing an earlier load (hits), and the number of actual loads (misses).
+  """
+  with _loaded_files_lock:
+    return dict(_loaded_files_stats)
+
+def add_loaded_files_stats(stats):
+  "Add the counts of loaded_files_stats() made in another process to these."
+  with _loaded_files_lock:
+    for (k, v) in stats.items():
+      _loaded_files_stats[k] += v
+
+def _read_macros(root):
+  return FrozenDict([(x.attrib.get("name"), x.attrib.get("value"))
+    for x in root.findall("macro")])
+
+def _read_refs(root):
+  return FrozenDict([(r.attrib.get("id"),
+    FrozenDict([(x.tag, x.text) for x in r])) for r in root.findall("ref")])
 
 def _register_macros_from_file(macros, fname, config):
   src_dir = config["src_dir"]
@@ -22,13 +89,11 @@ def _register_macros_from_file(macros, fname, config):
     _register_error("A macro file could not be found at the path: %s" % fpath)
     return macros
   try:
-    src = open(fpath, "r").read()
-  except IOError:
+    loaded = _load_file(fpath, _read_macros)
+  except (IOError, OSError):
     _register_error("Macros could not be loaded from the path: %s" % fpath)
     return macros
-  root = etree.fromstring(src)
-  return dict_merge(macros, dict([(x.attrib.get("name"), x.attrib.get("value"))
-    for x in root.findall("macro")]))
+  return dict_merge(macros, loaded)
 
 def _register_refs_from_file(refs, fname, config):
   src_dir = config["src_dir"]
@@ -40,14 +105,11 @@ def _register_refs_from_file(refs, fname, config):
       % fpath)
     return refs
   try:
-    src = open(fpath, "r").read()
-  except IOError:
+    loaded = _load_file(fpath, _read_refs)
+  except (IOError, OSError):
     _register_error("References could not be loaded from the path: %s" % fpath)
     return refs
-  root = etree.fromstring(src)
-  return dict_merge(refs,
-    dict([(r.attrib.get("id"), dict([(x.tag, x.text) for x in r]))
-      for r in root.findall("ref")]))
+  return dict_merge(refs, loaded)
 
 def _parse_head(head, config):
   title = head.find("title")
@@ -90,32 +152,38 @@ def _resolve_internal_partag(par_tag, parsed, config):
   resolve_internal_tag("Riemann hypothesis", parsed)
   # => None
   """
-  all_tags = [p.get("tags", []) for p in parsed["body"]["pars"]]
-  for (i, ts) in enumerate(all_tags):
-    if par_tag in ts:
-      return {"par": i + 1}
+  n = parsed["body"]["tags"].get(par_tag)
+  if n:
+    return {"par": n}
+
+def _register_par_tags(tag_map, tags, n):
+  """
+  Add the tags of the n-th par to the map tag => par number, reporting
+  tags that are already taken by an earlier par.
+  """
+  for tag in tags:
+    m = tag_map.setdefault(tag, n)
+    if m != n and tag:
+      _register_error("Duplicate tag %s (pars %d and %d)." % (tag, m, n))
 
 def _resolve_external_partag(doc, par, config):
   """
-  Get the number of the par with tag `tag` in the document with name `doc`.
-  Takes also the parameter `parsed`, which should be the result of parsing
-  the current document, just in order to avoid re-parsing it.
+  Get the number of the par with tag `par` in the document with name `doc`,
+  using the tag index of src_dir.
   """
   src_dir = config["src_dir"]
-  fpath = None
   if not os.path.isdir(src_dir):
     _register_error("The given path %s is not a directory." % src_dir)
-  try:
-    fpath = "%s/%s.xml" % (src_dir, doc)
-    htex = open(fpath, encoding="utf8", mode="r").read()
-    parsed = parse(htex, config)
-  except:
+  fpath = "%s/%s.xml" % (src_dir, doc)
+  instrument.count("external_resolutions")
+  tags = config["tag_index"].tags(doc)
+  if tags is None:
     return {"doc": doc, "path": fpath, "par": 0}
-  r = _resolve_internal_partag(par, parsed, config)
-  if not r:
+  n = tags.get(par)
+  if not n:
     _register_error("Could not resolve tag (%s, %s)." % (doc, par))
     return {"doc": doc, "path": fpath, "par": 0}
-  return dict_merge(r, {"doc": doc, "path": fpath})
+  return {"doc": doc, "path": fpath, "par": n}
 
 def _parse_citation_tag(element, config):
   ref = element.attrib.get("ref")
@@ -126,10 +194,9 @@ def _parse_citation_tag(element, config):
     x = {"type": "citation", "tag": tag, "pre": pre, "post": post}
     (doc, par) = _parse_partag(tag)
     if doc:
-      return dict_merge(x, _resolve_external_partag(doc, par, config))
-    else:
-      # internal tag - will have to get it on second pass
-      return x
+      x.update(_resolve_external_partag(doc, par, config))
+    # otherwise it's an internal tag - will have to get it on second pass
+    return x
   elif ref:
     return {"type": "external_citation",
       "refid": ref, "pre": pre, "post": post}
@@ -139,10 +206,9 @@ def _parse_term_tag(element, config):
   x = {"type": "term", "tag": tag}
   (doc, par) = _parse_partag(tag)
   if doc:
-    return dict_merge(x, _resolve_external_partag(doc, par, config))
-  else:
-    # internal tag - will have to get it on second pass
-    return x
+    x.update(_resolve_external_partag(doc, par, config))
+  # otherwise it's an internal tag - will have to get it on second pass
+  return x
 
 def _parse_inline_tag(element, config):
   "Return the type of an inline tag (e.g. b => bold)."
@@ -175,54 +241,159 @@ def _parse_inline_tag(element, config):
   elif element.tag == "sup":
     return {"type": "superscript"}
 
+def _make_node(node, config):
+  "Convert a dict node to a Node if the config asks for it."
+  if config.get("nodes"):
+    return nodes.from_dict(node)
+  return node
+
 def _parse_node(element, config):
   """
   Parse a node (block tag or inline tag).
   Block tags are def, thm, prp, lem, cor, rmk, exm, prf.
   Inline tags are b, i, u, d, cite, term, frml.
   """
-  content = (([element.text] if element.text else [])
-    + sum([[_parse_node(child, config), child.tail or ""]
-        for child in element], []))
+  content = []
+  if element.text:
+    content.append(element.text)
+  for child in element:
+    content.append(_parse_node(child, config))
+    content.append(child.tail or "")
   if element.tag in PAR_TAGS:
-    return {"content": content}
+    return _make_node({"content": content}, config)
   elif element.tag in BLOCK_TAGS:
-    return {"type": element.tag, "content": content}
+    return _make_node({"type": element.tag, "content": content}, config)
   elif element.tag in INLINE_TAGS:
-    x = dict_merge(_parse_inline_tag(element, config), {"content": content})
+    x = _parse_inline_tag(element, config)
     if x["type"] == "formula":
       # strip whitespace from beginning/end of formulas
-      return dict_merge(x, {"content": map(str.strip, x["content"])})
-    return x
-  return {"content": content}
-
-def _parse_body_pars(pars, element, config):
-  if element.tag in PAR_TAGS:
-    return pars + [{
-      "type":    element.tag,
-      "content": [_parse_node(element, config)],
-      "tags":    element.attrib.get("tag", "").split(";")}]
-  return pars
+      content = [s.strip() for s in content]
+    x["content"] = content
+    return _make_node(x, config)
+  return _make_node({"content": content}, config)
 
 def _parse_body(body, config):
-  return {"body": {"pars":
-    reduce(lambda x,y: _parse_body_pars(x, y, config), body, [])}}
+  pars = []
+  tag_map = {}
+  for element in body:
+    if element.tag in PAR_TAGS:
+      tags = element.attrib.get("tag", "").split(";")
+      pars.append(_make_node({
+        "type":    element.tag,
+        "content": [_parse_node(element, config)],
+        "tags":    tags}, config))
+      _register_par_tags(tag_map, tags, len(pars))
+  return {"body": {"pars": pars, "tags": tag_map}}
 
 def _parse_first_gen(parsed, element, config):
   if element.tag == "head":
-    return dict_merge(parsed, _parse_head(element, config))
-  if element.tag == "body":
-    return dict_merge(parsed, _parse_body(element, config))
+    parsed.update(_parse_head(element, config))
+  elif element.tag == "body":
+    parsed.update(_parse_body(element, config))
   return parsed
 
+# the things _fix_angle_brackets looks at: comments and CDATA sections (left
+# alone), < that can't start a tag, and ]]> outside of CDATA sections, which
+# XML doesn't allow in text
+_STRAY_BRACKETS = re.compile(
+  r"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<(?![A-Za-z_:/!?])|\]\]>", re.S)
+
+def _escape_stray_bracket(m):
+  s = m.group(0)
+  if s == "<":
+    return "&lt;"
+  elif s == "]]>":
+    return "]]&gt;"
+  return s
+
 def _fix_angle_brackets(htex):
   """
-  A hack to make sure lxml doesn't complain about angle brackets
-  that are not part of XML tags.
+  Make sure lxml doesn't complain about angle brackets that are not part of
+  XML tags (e.g. in formulas), by escaping each < that is not followed by
+  the start of a tag name, /, ! or ?.  A > is fine in XML text, so it is
+  left alone.  This is a single linear scan of htex.
+  """
+  return _STRAY_BRACKETS.sub(_escape_stray_bracket, htex)
+
+def _fixed_pieces(data):
+  """
+  Generate the pieces of the result of _fix_angle_brackets on data, a str or
+  a memory-mapped file, without making a copy of all of it at once.
   """
-  htex = re.sub(r"<(\s+)", r"&lt;\1", htex)
-  htex = re.sub(r"([^a-z\"\/\-]+)>", r"\1&gt;", htex)
-  return htex
+  pos = 0
+  for m in _STRAY_BRACKETS.finditer(data):
+    escaped = _escape_stray_bracket(m)
+    if escaped != m.group(0):
+      yield data[pos:m.start()]
+      yield escaped
+      pos = m.end()
+  yield data[pos:]
+
+def _read_xml(data, chunk_size=65536):
+  """
+  Parse a source given as bytes (a str or a memory-mapped file) with lxml,
+  after _fix_angle_brackets, and return the root element.  The source is
+  fed to lxml in chunks of about chunk_size bytes as it is fixed, without
+  being decoded first: lxml finds its encoding itself, which must be an
+  ASCII-compatible one such as utf8.
+  """
+  parser = etree.XMLParser()
+  pieces = []
+  size = 0
+  for piece in _fixed_pieces(data):
+    pieces.append(piece)
+    size += len(piece)
+    if size >= chunk_size:
+      parser.feed("".join(pieces))
+      pieces = []
+      size = 0
+  parser.feed("".join(pieces))
+  return parser.close()
+
+@contextmanager
+def map_source(path):
+  """
+  Memory-map the source file at path, for parse():
+
+    with map_source(path) as htex:
+      parsed = parse(htex, config)
+  """
+  with open(path, "rb") as f:
+    try:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      # an empty file can't be mapped
+      yield ""
+      return
+    try:
+      yield data
+    finally:
+      data.close()
+
+_SECTION_STARTS = re.compile(r"<!--|<!\[CDATA\[")
+_SECTION_ENDS = {"<!--": "-->", "<![CDATA[": "]]>"}
+
+def _fix_angle_brackets_cut(text):
+  """
+  Return a position where text can be cut so that applying
+  _fix_angle_brackets to both parts gives the same result as applying it to
+  all of text: right before a comment or CDATA section that isn't closed
+  yet, or else right before the last < that isn't in one.  Without any such
+  <, it can be cut anywhere but in a ]]>.
+  """
+  pos = 0
+  while True:
+    m = _SECTION_STARTS.search(text, pos)
+    if not m:
+      break
+    end = text.find(_SECTION_ENDS[m.group(0)], m.end())
+    if end < 0:
+      return m.start()
+    pos = end + len(_SECTION_ENDS[m.group(0)])
+  cut = text.rfind("<", pos)
+  if cut >= 0:
+    return cut
+  return max(pos, len(text.rstrip("]")))
 
 def _resolve_internal_citations_in_node(node, parsed, config):
   if type(node) in (str, unicode):
@@ -234,9 +405,11 @@ def _resolve_internal_citations_in_node(node, parsed, config):
       r = _resolve_internal_partag(par, parsed, config)
       if not r:
         r = {"par": 0}
-      return dict_merge(node, r)
-  return dict_merge(node, {"content":
-    [_resolve_internal_citations_in_node(x, parsed, config) for x in node.get("content")]})
+      node.update(r)
+      return node
+  for x in node.get("content"):
+    _resolve_internal_citations_in_node(x, parsed, config)
+  return node
 
 def _register_cited_ref_ids(node, cited_ref_ids, parsed, config):
   if type(node) in (str, unicode):
@@ -250,36 +423,280 @@ def _register_cited_ref_ids(node, cited_ref_ids, parsed, config):
       _register_error("External reference not found: %s" % node.get("refid"))
     return cited_ref_ids
   for x in node.get("content"):
-    cited_ref_ids.update(
-      _register_cited_ref_ids(x, cited_ref_ids, parsed, config))
+    _register_cited_ref_ids(x, cited_ref_ids, parsed, config)
   return cited_ref_ids
 
-def parse(htex, config={}):
-  config = dict_merge({"src_dir": "./"}, config)
-  htex = _fix_angle_brackets(htex)
-  root = etree.fromstring(htex)
-  parsed = reduce(lambda x,y: _parse_first_gen(x,y,config), root, {})
+def _register_external_citations(node, citations):
+  if type(node) in (str, unicode):
+    return citations
+  if node.get("type") in ("citation", "term") and node.get("doc"):
+    (doc, par) = _parse_partag(node.get("tag"))
+    citations.add((doc, par, node.get("par")))
+  for x in node.get("content"):
+    _register_external_citations(x, citations)
+  return citations
 
-  # second pass: resolve internal citations
-  parsed["body"]["pars"] = map(lambda p:
-    _resolve_internal_citations_in_node(p, parsed, config),
-    parsed["body"]["pars"])
+def _head_files(root, config):
+  "Return the paths of the macro and reference files used by a document."
+  files = []
+  for head in root.findall("head"):
+    for x in head.findall("macros") + head.findall("refs"):
+      files.append("%s/%s" % (config["src_dir"], x.attrib.get("src", "")))
+  return files
 
-  # get a sorted list of cited references
-  cited_ref_ids = set()
-  for p in parsed["body"]["pars"]:
-    cited_ref_ids.update(
-      _register_cited_ref_ids(p, cited_ref_ids, parsed, config))
+def _number_cited_refs(parsed, cited_ref_ids):
+  """
+  Sort the cited references, and replace parsed["refs"] by a dictionary of
+  the cited references with keys (indicating the sort order).
+  """
   cited_ref_ids = sorted(list(cited_ref_ids),
     key=lambda x: parsed["refs"][x].get("author"))
   parsed["cited_ref_ids"] = cited_ref_ids
 
-  # make a dictionary of the cited references, with keys
-  # (indicating the sort order)
   refs = []
   for (i, rid) in enumerate(cited_ref_ids):
     refs.append(dict_merge({"id": rid, "key": str(i + 1)},
       parsed["refs"].get(rid)))
   parsed["refs"] = dict([(r["id"], r) for r in refs])
 
+def _make_config(config):
+  config = dict_merge({"src_dir": "./", "cache_dir": None, "nodes": False,
+    "ast_cache": False}, config)
+  if config.get("tag_index") is None:
+    config["tag_index"] = index.get_tag_index(config["src_dir"],
+      config["cache_dir"])
+    config["tag_index"].begin_run()
+  return config
+
+def _parse(htex, config):
+  with instrument.phase("parse"):
+    if isinstance(htex, unicode):
+      with instrument.phase("parse.fix_angle_brackets"):
+        htex = _fix_angle_brackets(htex)
+      with instrument.phase("parse.lxml"):
+        root = etree.fromstring(htex)
+    else:
+      with instrument.phase("parse.lxml"):
+        root = _read_xml(htex)
+    parsed = {}
+    with instrument.phase("parse.tree"):
+      for element in root:
+        _parse_first_gen(parsed, element, config)
+
+    with instrument.phase("parse.resolve"):
+      # second pass: resolve internal citations
+      for p in parsed["body"]["pars"]:
+        _resolve_internal_citations_in_node(p, parsed, config)
+
+      # get a sorted list of cited references
+      cited_ref_ids = set()
+      for p in parsed["body"]["pars"]:
+        _register_cited_ref_ids(p, cited_ref_ids, parsed, config)
+      _number_cited_refs(parsed, cited_ref_ids)
+
+      # record what the result depends on besides htex itself
+      citations = set()
+      for p in parsed["body"]["pars"]:
+        _register_external_citations(p, citations)
+      parsed["deps"] = {
+        "files":     _head_files(root, config),
+        "citations": sorted(citations)}
+
+  instrument.count("documents_parsed")
+  return parsed
+
+def _file_hash(path):
+  try:
+    return hashlib.md5(open(path, "rb").read()).hexdigest()
+  except IOError:
+    return None
+
+def _ast_cache_path(htex, config):
+  """
+  The path of the cached result of parsing htex.  It depends on the source,
+  the parser version and the options which change the result.
+  """
+  key = hashlib.sha1("\n".join([str(PARSER_VERSION),
+    os.path.abspath(config["src_dir"]), str(bool(config["nodes"])),
+    ""]).encode("utf8"))
+  if isinstance(htex, unicode):
+    htex = htex.encode("utf8")
+  key.update(htex)
+  digest = key.hexdigest()
+  return os.path.join(config["cache_dir"], "asts", digest + ".pickle")
+
+def _load_cached_ast(path, config):
+  """
+  Return the parsed document cached at path, or None if there is none or it
+  is out of date, i.e. one of its macro or reference files or the number of
+  a par it cites has changed.
+  """
+  try:
+    entry = cPickle.load(open(path, "rb"))
+  except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+    return None
+  if entry.get("version") != PARSER_VERSION:
+    return None
+  for (f, digest) in entry["files"].items():
+    if _file_hash(f) != digest:
+      return None
+  for (doc, tag, par) in entry["parsed"]["deps"]["citations"]:
+    if (config["tag_index"].lookup(doc, tag) or 0) != par:
+      return None
+  for message in entry["errors"]:
+    _register_error(message)
+  return entry["parsed"]
+
+def _save_cached_ast(path, parsed, errors):
+  dirname = os.path.dirname(path)
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  entry = {
+    "version": PARSER_VERSION,
+    "files":   dict((f, _file_hash(f)) for f in parsed["deps"]["files"]),
+    "errors":  errors,
+    "parsed":  parsed}
+  (f, tmppath) = tempfile.mkstemp(dir=dirname)
+  with os.fdopen(f, "wb") as out:
+    cPickle.dump(entry, out, 2)
+  os.rename(tmppath, path)
+
+def _parse_cached(htex, config):
+  path = _ast_cache_path(htex, config)
+  parsed = _load_cached_ast(path, config)
+  if parsed is not None:
+    instrument.count("ast_cache.hits")
+    return parsed
+  instrument.count("ast_cache.misses")
+  _errors.log = []
+  try:
+    parsed = _parse(htex, config)
+    errors = _errors.log
+  finally:
+    _errors.log = None
+  _save_cached_ast(path, parsed, errors)
+  return parsed
+
+def parse(htex, config={}):
+  """
+  Parse a HyperTeX document, given as unicode, or as bytes (a str or a
+  memory-mapped file, see map_source) whose encoding lxml finds out.
+
+  With the config option {"ast_cache": True} and a cache_dir, the result is
+  kept in cache_dir/asts and reused as long as the source, its macro and
+  reference files and the numbers of the pars it cites stay the same.  Cache
+  files are written atomically, so several processes can share a cache.
+
+  The tag index, which external citations are looked up in, isn't saved
+  here, but once at the end of the run: see hypertex.index.save_tag_indices.
+  """
+  config = _make_config(config)
+  if config["ast_cache"] and config["cache_dir"]:
+    return _parse_cached(htex, config)
+  return _parse(htex, config)
+
+class _SourceReader(object):
+  """
+  A file-like object which reads a HyperTeX source from a utf8 file and
+  applies _fix_angle_brackets to it on the fly, returning utf8.  The text is
+  only ever cut where _fix_angle_brackets_cut allows, so the result is the
+  same as that of fixing the whole text at once.
+  """
+
+  def __init__(self, path, chunk_size=65536):
+    self.f = open(path, encoding="utf8", mode="r")
+    self.chunk_size = chunk_size
+    self.carry = u""
+    self.buf = ""
+
+  def _fill(self):
+    while not self.buf:
+      chunk = self.f.read(self.chunk_size)
+      if not chunk:
+        text = self.carry
+        self.carry = u""
+        self.buf = _fix_angle_brackets(text).encode("utf8")
+        return
+      text = self.carry + chunk
+      cut = _fix_angle_brackets_cut(text)
+      self.carry = text[cut:]
+      if cut:
+        self.buf = _fix_angle_brackets(text[:cut]).encode("utf8")
+
+  def read(self, n=-1):
+    self._fill()
+    if n < 0:
+      n = len(self.buf)
+    (data, self.buf) = (self.buf[:n], self.buf[n:])
+    return data
+
+  def close(self):
+    self.f.close()
+
+def _iter_elements(path, tags):
+  """
+  Yield the elements with the given tags of the document at path, as they
+  are closed.  Each par is freed, along with what came before it, once the
+  consumer moves on.
+  """
+  reader = _SourceReader(path)
+  try:
+    for (_, element) in etree.iterparse(reader, events=("end",), tag=tags):
+      yield element
+      if element.tag in PAR_TAGS:
+        element.clear()
+        while element.getprevious() is not None:
+          del element.getparent()[0]
+  finally:
+    reader.close()
+
+def _stream_pars(path, tag_map, config):
+  # a stand-in for the parsed document, to resolve internal citations
+  parsed = {"body": {"tags": tag_map}}
+  for element in _iter_elements(path, PAR_TAGS):
+    if element.getparent().tag != "body":
+      continue
+    p = _make_node({
+      "type":    element.tag,
+      "content": [_parse_node(element, config)],
+      "tags":    element.attrib.get("tag", "").split(";")}, config)
+    yield _resolve_internal_citations_in_node(p, parsed, config)
+
+def iterparse(path, config={}):
+  """
+  Parse the document at path without holding all of it in memory.  The
+  result is like that of parse(), except that parsed["body"]["pars"] is a
+  generator which parses each par only when it is reached, and that there is
+  no parsed["deps"].
+
+  The document is read twice: a first pass collects the head, the tags of
+  the pars and the cited references, so that citations (even to later pars)
+  can be resolved as soon as a par is parsed.
+  """
+  config = _make_config(config)
+  parsed = {"title": "", "author": "", "macros": {}, "refs": {}}
+  tag_map = {}
+  n = 0
+  ref_ids = []
+  for element in _iter_elements(path, ["head", "cite"] + PAR_TAGS):
+    if element.tag == "head":
+      parsed.update(_parse_head(element, config))
+    elif element.tag == "cite":
+      if element.attrib.get("ref") and not element.attrib.get("tag"):
+        ref_ids.append(element.attrib.get("ref"))
+    elif element.getparent().tag == "body":
+      n += 1
+      _register_par_tags(tag_map,
+        element.attrib.get("tag", "").split(";"), n)
+
+  cited_ref_ids = set()
+  for rid in ref_ids:
+    if parsed["refs"].get(rid):
+      cited_ref_ids.add(rid)
+    else:
+      _register_error("External reference not found: %s" % rid)
+  _number_cited_refs(parsed, cited_ref_ids)
+
+  parsed["body"] = {"pars": _stream_pars(path, tag_map, config),
+                    "tags": tag_map}
   return parsed
@@ -0,0 +1,32 @@
+import importlib
+
+# format => module of its renderer
+RENDERERS = {"html": "hypertex.render.html",
+             "tex":  "hypertex.render.tex"}
+
+def renderer(format):
+  """
+  The renderer module of the given format.  It is only imported the first
+  time it is needed, so that e.g. rendering TeX doesn't load what's needed
+  for HTML and its images.
+  """
+  return importlib.import_module(RENDERERS[format])
+
+# folder => Jinja environment
+_envs = {}
+
+def template_env(folder):
+  """
+  The Jinja environment of the templates in hypertex/render/folder, made
+  the first time it is needed (jinja2 is only imported then).  Templates
+  are not checked for changes once loaded, and their compiled code is kept
+  in a bytecode cache in the temporary directory, so that new processes
+  don't have to compile them again.
+  """
+  env = _envs.get(folder)
+  if env is None:
+    from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache
+    env = _envs.setdefault(folder, Environment(
+      loader=PackageLoader("hypertex.render", folder),
+      auto_reload=False, bytecode_cache=FileSystemBytecodeCache()))
+  return env
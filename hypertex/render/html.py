@@ -1,17 +1,21 @@
 __name__ = "html"
 
-import os.path
-import codecs
-import tempfile
-import subprocess
-import hashlib
-from jinja2 import Environment, PackageLoader
-import wand.image, wand.color
+import re
 
 from hypertex.constants import BLOCK_TAGS
+from hypertex import instrument
+from hypertex.render import images, template_env
 from hypertex.util import dict_merge
 
-tmpl_env = Environment(loader=PackageLoader("hypertex.render", "html"))
+# name => template, for the templates loaded so far
+_templates = {}
+
+def _template(name):
+  "Return the template called name, which is only looked up once."
+  template = _templates.get(name)
+  if template is None:
+    template = _templates[name] = template_env("html").get_template(name)
+  return template
 
 def _render_content(node, parsed, config):
   if type(node) in (str, unicode):
@@ -30,17 +34,18 @@ def _render_citation(node, parsed, config):
   else:
     url = "#%d" % par
 
-  template = tmpl_env.get_template("citation.html")
-  content = template.render({
-    "doc":  doc,
-    "num":  str(par),
-    "url":  url,
-    "text": text})
-  return content
+  # the same as citation.html, without going through Jinja
+  if text:
+    link = u"<a href=\"%s\">%s</a>" % (url, text)
+  elif doc:
+    link = u"(<a href=\"%s\">%s/%s</a>)" % (url, doc, par)
+  else:
+    link = u"(<a href=\"%s\">%s</a>)" % (url, par)
+  return u"<span class=\"citation\">%s</span>" % link
 
 def _render_external_citation(node, parsed, config):
   text = _render_content(node, parsed, config)
-  template = tmpl_env.get_template("external_citation.html")
+  template = _template("external_citation.html")
   refid = node.get("refid")
   ref = parsed["refs"].get(refid)
   content = template.render(dict_merge(ref,
@@ -56,13 +61,8 @@ def _render_term(node, parsed, config):
   else:
     url = "#%d" % par
 
-  template = tmpl_env.get_template("term.html")
-  content = template.render({
-    "doc":  doc,
-    "num":  str(par),
-    "url":  url,
-    "text": text})
-  return content
+  # the same as term.html, without going through Jinja
+  return u"<span class=\"term\"><a href=\"%s\">%s</a></span>" % (url, text)
 
 def _render_ord_list(node, parsed, config):
   content = _render_content(node, parsed, config)
@@ -76,49 +76,20 @@ def _render_list_item(node, parsed, config):
   content = _render_content(node, parsed, config)
   return "<li>%s</li>" % content
 
-def _render_formula_as_pdf(formula, macros):
-  "Takes a LaTeX formula and returns a path to a PDF."
-  template = tmpl_env.get_template("formula.tex")
-  tex = template.render({
-    "formula": formula,
-    "macros":  macros.items()})
-  (f, path) = tempfile.mkstemp()
-  codecs.open(path, encoding="utf8", mode="w").write(tex)
-  
-  p = subprocess.Popen(["pdflatex",
-    "-interaction=batchmode", "-output-dir=%s" % os.path.dirname(path),
-    path],
-    stdout=subprocess.PIPE)
-  out, err = p.communicate()
-  if err:
-    print err
-  return path + ".pdf"
-
-def _generate_formula_filename(formula, macros):
-  s = formula + repr(macros)
-  return hashlib.md5(s).hexdigest() + ".png"
-
-def _get_formula_png_path(formula, macros, img_dir):
-  return "%s/%s" % (img_dir, _generate_formula_filename(formula, macros))
-
-def _render_formula_as_image(formula, macros, img_dir):
-  "Takes a LaTeX formula and returns a path to a PNG."
-  pngpath = _get_formula_png_path(formula, macros, img_dir)
-  if os.path.exists(pngpath):
-    return pngpath
-
-  print "Rendering formula...\n%s" % formula
-  pdfpath = _render_formula_as_pdf(formula, macros)
-
-  p = subprocess.Popen(["convert",
-    "-density", "120", "-trim", "-transparent", "#FFFFFF",
-    pdfpath, pngpath],
-    stdout=subprocess.PIPE)
-  out, err = p.communicate()
-  if err:
-    print err
-
-  return pngpath
+# stands for the n-th formula image which is still being rendered
+_PENDING_FORMULA = u"\x00formula %d\x00"
+
+def _formula_image(formula, parsed, config):
+  """
+  The HTML of a formula whose image has been rendered, or of the formula
+  itself if there is no image (e.g. because pdflatex timed out).
+  """
+  cache = images.get_cache(config["img_dir"])
+  name = images.formula_filename(formula, parsed["macros"])
+  if cache.has(name):
+    img_url = "%s/%s" % (config["img_base_url"], name)
+    return "<div class=\"formula\"><img src=\"%s\" alt=\"%s\" /></div>" % (img_url, formula)
+  return "<div class=\"formula\">%s</div>" % formula
 
 def _render_formula(node, parsed, config):
   """
@@ -132,12 +103,15 @@ def _render_formula(node, parsed, config):
     if not config["img_dir"]:
       print "Error: no img_dir provided.  Skipping formula."
       return ""
-    img_path = _render_formula_as_image(formula, parsed["macros"], config["img_dir"])
-    if img_path:
-      img_url = "%s/%s" % (config["img_base_url"], os.path.basename(img_path))
-      content = "<div class=\"formula\"><img src=\"%s\" alt=\"%s\" /></div>" % (img_url, formula)
-    else:
-      content = "<div class=\"formula\">%s</div>" % formula
+    pending = config.get("_pending_formulas")
+    if pending is not None:
+      # filled in by render() once the image has been rendered
+      pending.append(formula)
+      return _PENDING_FORMULA % (len(pending) - 1)
+    if not config.get("_images_rendered"):
+      images.render_formula_as_image(formula, parsed["macros"],
+        config["img_dir"], config["formula_timeout"], config["rasterizer"])
+    content = _formula_image(formula, parsed, config)
   else:
     content = "<div class=\"formula\">\[ %s \]</div>" % formula
   return content
@@ -148,68 +122,182 @@ def _render_subscript(node, parsed, config):
 def _render_superscript(node, parsed, config):
   return "<sup>%s</sup>" % _render_content(node, parsed, config)
 
+def _render_block(node, parsed, config):
+  content = _render_content(node, parsed, config)
+  template = _template("block.html")
+  return template.render({"block": dict_merge(node, {"content": content})})
+
+# node type => format string for nodes that just wrap their content
+_WRAPPERS = {
+  "paragraph":  "<p>%s</p>",
+  "bold":       "<b>%s</b>",
+  "italic":     "<i>%s</i>",
+  "definition": "<span class=\"definition\">%s</span>"}
+
+# node type => function that renders it
+_RENDERERS = dict([(t, _render_block) for t in BLOCK_TAGS] + [
+  ("citation",          _render_citation),
+  ("term",              _render_term),
+  ("external_citation", _render_external_citation),
+  ("formula",           _render_formula),
+  ("ord_list",          _render_ord_list),
+  ("unord_list",        _render_unord_list),
+  ("list_item",         _render_list_item),
+  ("subscript",         _render_subscript),
+  ("superscript",       _render_superscript)])
+
 def _render_node(node, parsed, config):
   if type(node) in (str, unicode):
     return node
+  type_ = node.get("type")
+  renderer = _RENDERERS.get(type_)
+  if renderer is not None:
+    return renderer(node, parsed, config)
   content = _render_content(node, parsed, config)
-  if node.get("type") in BLOCK_TAGS:
-    template = tmpl_env.get_template("block.html")
-    return template.render({"block": dict_merge(node, {"content": content})})
-  if node.get("type") == "paragraph":
-    return "<p>%s</p>" % content
-  if node.get("type") == "bold":
-    return "<b>%s</b>" % content
-  if node.get("type") == "italic":
-    return "<i>%s</i>" % content
-  if node.get("type") == "definition":
-    return "<span class=\"definition\">%s</span>" % content
-  if node.get("type") == "citation":
-    return _render_citation(node, parsed, config)
-  if node.get("type") == "term":
-    return _render_term(node, parsed, config)
-  if node.get("type") == "external_citation":
-    return _render_external_citation(node, parsed, config)
-  if node.get("type") == "formula":
-    return _render_formula(node, parsed, config)
-  if node.get("type") == "ord_list":
-    return _render_ord_list(node, parsed, config)
-  if node.get("type") == "unord_list":
-    return _render_unord_list(node, parsed, config)
-  if node.get("type") == "list_item":
-    return _render_list_item(node, parsed, config)
-  if node.get("type") == "subscript":
-    return _render_subscript(node, parsed, config)
-  if node.get("type") == "superscript":
-    return _render_superscript(node, parsed, config)
+  if type_ in _WRAPPERS:
+    return _WRAPPERS[type_] % content
   return content
 
 def _render_par(par, parsed, config):
   return "".join(_render_node(n, parsed, config) for n in par.get("content"))
 
-def _escape_macros(macros):
-  return [(k, v.replace("\\", "\\\\")) for (k, v) in macros.items()]
+def _collect_image_formulas(node, parsed, config, formulas):
+  "Collect the formulas in node that are to be rendered as images."
+  if type(node) in (str, unicode):
+    return formulas
+  if node.get("type") == "formula" and node.get("img"):
+    formulas.append((_render_content(node, parsed, config), parsed["macros"]))
+    return formulas
+  for x in node.get("content", []):
+    _collect_image_formulas(x, parsed, config, formulas)
+  return formulas
 
-def render(parsed, config={}):
+def image_formulas(parsed):
   """
-  Takes a parsed hypertex file and renders it as HTML.
-  Accepts a config dict which should contain img_dir and img_base_url when
-  the output format is HTML.
+  Return the list of pairs (formula, macros) of the formulas in a parsed
+  document that are rendered as images.
   """
+  formulas = []
+  for p in parsed["body"]["pars"]:
+    _collect_image_formulas(p, parsed, {}, formulas)
+  return formulas
+
+def _escape_macros(macros):
+  return [(k, v.replace("\\", "\\\\")) for (k, v) in macros.items()]
+
+def _make_config(config):
   config = dict_merge(
-    {"img_dir": None, "img_base_url": "", "src_base_url": ""},
+    {"img_dir": None, "img_base_url": "", "src_base_url": "",
+     "jobs": 1, "batch_formulas": False, "img_cache_size": None,
+     "formula_timeout": None, "async_formulas": False,
+     "rasterizer": "convert", "backlinks": None},
     config)
-  base = config["src_base_url"]
+  # no base url (None) means relative links
+  base = config["src_base_url"] or ""
   if base and not base.endswith("/"):
-    config["src_base_url"] = base + "/"
-  template = tmpl_env.get_template("template.html")
-  pars = [dict_merge(p, {"content": _render_par(p, parsed, config)})
-    for p in parsed["body"]["pars"]]
+    base += "/"
+  config["src_base_url"] = base
+  return config
+
+def _cited_by(par, config):
+  """
+  The links to the pars citing par, from the backlinks option: a map
+  tag => list of (doc, par number) for the tags of this document, where doc
+  is "" for this document (see hypertex.backlinks).
+  """
+  citing = set()
+  for tag in par.get("tags") or []:
+    citing.update(tuple(x) for x in config["backlinks"].get(tag, []))
+  links = []
+  for (doc, n) in sorted(citing):
+    if doc:
+      links.append({"url":  "%s%s.html#%d" % (config["src_base_url"], doc, n),
+                    "text": "%s/%d" % (doc, n)})
+    else:
+      links.append({"url": "#%d" % n, "text": "%d" % n})
+  return links
+
+def _render_pars(pars, parsed, config):
+  "Generate the pars with their rendered content, for the template."
+  for p in pars:
+    extra = {"content": _render_par(p, parsed, config)}
+    if config["backlinks"] is not None:
+      extra["cited_by"] = _cited_by(p, config)
+    yield dict_merge(p, extra)
+
+def _template_vars(parsed, pars):
   cited_refs = sorted(parsed["refs"].values(), key=lambda x: x.get("key"))
-  html = template.render({
+  return {
     "title":      parsed["title"],
     "author":     parsed["author"],
     "macros":     _escape_macros(parsed["macros"]),
     "pars":       pars,
     "refs":       parsed["refs"],
-    "cited_refs": cited_refs})
-  return html
+    "cited_refs": cited_refs}
+
+def render(parsed, config={}):
+  """
+  Takes a parsed hypertex file and renders it as HTML.
+  Accepts a config dict which should contain img_dir and img_base_url when
+  the output format is HTML.  Formula images are rendered on `jobs` threads,
+  and with batch_formulas several formulas share a run of pdflatex.  If
+  img_cache_size is set, img_dir is kept under that many bytes.  A run of
+  pdflatex or convert taking more than formula_timeout seconds is killed,
+  and its formulas are shown as text instead.  With rasterizer "wand", the
+  PDFs made by pdflatex are converted to PNG within the process if Wand is
+  installed, rather than by running convert.
+
+  If backlinks is given (see hypertex.backlinks.BacklinkIndex.doc_backlinks),
+  each par is followed by links to the pars which cite it.
+
+  With async_formulas, the images are rendered in the background while the
+  rest of the document is rendered, and filled in at the end.
+  """
+  config = _make_config(config)
+  with instrument.phase("render.html"):
+    job = None
+    if config["img_dir"]:
+      # render all the missing formula images at once, before the document
+      # (or while it is rendered)
+      with instrument.phase("render.html.images"):
+        job = images.render_formulas_as_images(image_formulas(parsed),
+          config["img_dir"], config["jobs"], config["batch_formulas"],
+          config["img_cache_size"], config["formula_timeout"],
+          config["async_formulas"], config["rasterizer"])
+      if config["async_formulas"]:
+        config["_pending_formulas"] = []
+      config["_images_rendered"] = True
+    rendered = False
+    try:
+      template = _template("template.html")
+      with instrument.phase("render.html.pars"):
+        pars = list(_render_pars(parsed["body"]["pars"], parsed, config))
+      with instrument.phase("render.html.template"):
+        output = template.render(_template_vars(parsed, pars))
+      rendered = True
+    finally:
+      if job is not None and not rendered:
+        # stop rendering the images, but still shut the pool down and save
+        # the image cache
+        job.cancel()
+        job.wait()
+    pending = config.get("_pending_formulas")
+    if pending is not None:
+      with instrument.phase("render.html.images.wait"):
+        job.wait()
+      output = re.sub(u"\x00formula (\\d+)\x00",
+        lambda m: _formula_image(pending[int(m.group(1))], parsed, config),
+        output)
+    return output
+
+def render_stream(parsed, config={}):
+  """
+  Like render(), but returns a generator of pieces of the HTML, and renders
+  each par only when the template reaches it.  Meant for the result of
+  hypertex.parser.iterparse.  Formula images are rendered one at a time as
+  they are reached.
+  """
+  config = _make_config(config)
+  template = _template("template.html")
+  pars = _render_pars(parsed["body"]["pars"], parsed, config)
+  return template.generate(_template_vars(parsed, pars))
@@ -0,0 +1,514 @@
+__name__ = "images"
+
+import os
+import os.path
+import re
+import signal
+import json
+import time
+import codecs
+import shutil
+import tempfile
+import threading
+import subprocess
+import hashlib
+
+from hypertex import instrument
+from hypertex.util import locked
+from hypertex.render import template_env
+
+MANIFEST_VERSION = 1
+
+# the prefix of the temporary files in img_dir, and the age in seconds after
+# which gc() takes one to be left over by a crash rather than in use
+TEMP_PREFIX = ".tmp-"
+TEMP_MAX_AGE = 3600
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# the mode of the images, which mkstemp creates readable by their owner only
+_umask = os.umask(0)
+os.umask(_umask)
+IMAGE_MODE = 0666 & ~_umask
+
+# (wand.image, white, WandException), once Wand has been imported, or False if
+# Wand or the MagickWand library is not available
+_wand = None
+_wand_lock = threading.Lock()
+
+def used_macros(formula, macros):
+  """
+  Return the sorted list of pairs (name, value) of the macros which are used
+  in formula, either directly or through other macros.
+  """
+  used = {}
+  todo = [formula]
+  while todo:
+    for name in re.findall(r"\\([A-Za-z]+)", todo.pop()):
+      if name in macros and name not in used:
+        used[name] = macros[name]
+        todo.append(macros[name])
+  return sorted(used.items())
+
+def formula_filename(formula, macros):
+  """
+  The name of the PNG of a formula.  It only depends on the formula and on
+  the macros it uses, so adding a macro to a document doesn't change the
+  names of the images of formulas that don't use it.
+  """
+  key = "\n".join([formula.strip()] +
+    ["\\%s=%s" % (k, v) for (k, v) in used_macros(formula, macros)])
+  return hashlib.sha1(key.encode("utf8")).hexdigest() + ".png"
+
+class ImageCache(object):
+  """
+  The formula images in img_dir, along with a manifest (manifest.json) of
+  their sizes and last use, and hit/miss statistics.  An image only counts as
+  cached if it is in the manifest with the right size, so a file left
+  truncated by a crash is rendered again.  Several processes can share
+  img_dir: the manifest on disk is merged into this one when saving, under a
+  lock on manifest.json.lock.
+  """
+
+  def __init__(self, img_dir):
+    self.img_dir = img_dir
+    self.path = os.path.join(img_dir, "manifest.json")
+    self.lock = threading.RLock()
+    self.images = {}
+    # the images removed by this process, which are not to be merged back
+    self.removed = set()
+    self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+    data = self._read_manifest()
+    if data:
+      self.images = data["images"]
+      self.stats.update(data["stats"])
+    # the stats as of the last read or save of the manifest, so that only the
+    # counts of this process are added to the ones on disk
+    self.saved_stats = dict(self.stats)
+
+  def _read_manifest(self):
+    try:
+      data = json.load(open(self.path, "r"))
+    except (IOError, ValueError):
+      return None
+    if data.get("version") != MANIFEST_VERSION or "images" not in data:
+      return None
+    return data
+
+  def image_path(self, name):
+    return "%s/%s" % (self.img_dir, name)
+
+  def has(self, name):
+    entry = self.images.get(name)
+    if entry is None:
+      return False
+    try:
+      return os.path.getsize(self.image_path(name)) == entry["size"]
+    except OSError:
+      return False
+
+  def lookup(self, name):
+    "Like has(), but counts a hit or miss and marks the image as used."
+    with self.lock:
+      if self.has(name):
+        self.stats["hits"] += 1
+        self.images[name]["last_used"] = time.time()
+        instrument.count("images.hits")
+        return True
+      self.stats["misses"] += 1
+      instrument.count("images.misses")
+      return False
+
+  def temp_path(self):
+    "Return a new temporary path in img_dir, to be passed to commit()."
+    (f, path) = tempfile.mkstemp(dir=self.img_dir, prefix=TEMP_PREFIX,
+      suffix=".png")
+    os.close(f)
+    return path
+
+  def commit(self, tmppath, name):
+    """
+    Atomically move a freshly rendered image into the cache.  Empty files are
+    discarded.
+    """
+    size = os.path.getsize(tmppath) if os.path.exists(tmppath) else 0
+    if not size:
+      if os.path.exists(tmppath):
+        os.remove(tmppath)
+      return False
+    os.chmod(tmppath, IMAGE_MODE)
+    os.rename(tmppath, self.image_path(name))
+    with self.lock:
+      now = time.time()
+      self.images[name] = {"size": size, "created": now, "last_used": now}
+      self.removed.discard(name)
+    return True
+
+  def _remove(self, name):
+    try:
+      os.remove(self.image_path(name))
+    except OSError:
+      pass
+    self.images.pop(name, None)
+    self.removed.add(name)
+
+  def evict(self, max_size, keep=()):
+    """
+    Remove the least recently used images until the cache takes at most
+    max_size bytes.  The images in keep are never removed.
+    """
+    with self.lock:
+      total = sum(e["size"] for e in self.images.values())
+      by_age = sorted(self.images.items(), key=lambda x: x[1]["last_used"])
+      for (name, entry) in by_age:
+        if total <= max_size:
+          break
+        if name in keep:
+          continue
+        self._remove(name)
+        total -= entry["size"]
+        self.stats["evictions"] += 1
+
+  def gc(self, keep):
+    """
+    Delete every image (and leftover temporary file) in img_dir whose name
+    is not in keep.  Temporary files younger than TEMP_MAX_AGE are left
+    alone, since another process may be about to commit them.  Returns the
+    names of the deleted files.
+    """
+    removed = []
+    now = time.time()
+    with self.lock:
+      for fname in os.listdir(self.img_dir):
+        if not fname.endswith(".png") or fname in keep:
+          continue
+        if fname.startswith(TEMP_PREFIX):
+          try:
+            if now - os.path.getmtime(self.image_path(fname)) < TEMP_MAX_AGE:
+              continue
+          except OSError:
+            continue
+        self._remove(fname)
+        removed.append(fname)
+    return removed
+
+  def save(self):
+    with self.lock, locked(self.path + ".lock"):
+      data = self._read_manifest()
+      if data:
+        for (name, entry) in data["images"].items():
+          if name not in self.images and name not in self.removed:
+            self.images[name] = entry
+        for (k, v) in self.stats.items():
+          self.stats[k] = data["stats"].get(k, 0) + v - self.saved_stats[k]
+      (f, tmppath) = tempfile.mkstemp(dir=self.img_dir, prefix=TEMP_PREFIX)
+      with os.fdopen(f, "w") as out:
+        json.dump({"version": MANIFEST_VERSION, "images": self.images,
+                   "stats": self.stats}, out)
+      os.chmod(tmppath, IMAGE_MODE)
+      os.rename(tmppath, self.path)
+      self.saved_stats = dict(self.stats)
+
+def get_cache(img_dir):
+  "Return the image cache of img_dir, which is shared within the process."
+  img_dir = os.path.abspath(img_dir)
+  with _caches_lock:
+    if img_dir not in _caches:
+      if not os.path.isdir(img_dir):
+        os.makedirs(img_dir)
+      _caches[img_dir] = ImageCache(img_dir)
+    return _caches[img_dir]
+
+class RenderJob(object):
+  """
+  The rendering of a set of formula images, which may run in the background
+  (see render_formulas_as_images).  Each run of pdflatex or convert is killed
+  if it takes more than `timeout` seconds, and cancel() kills the running
+  ones and skips the rest.  PDFs are converted to PNG with `rasterizer`
+  (see _convert_pdf_to_png).
+  """
+
+  def __init__(self, timeout=None, rasterizer="convert"):
+    self.timeout = timeout
+    self.rasterizer = rasterizer
+    self.cancelled = threading.Event()
+    self.lock = threading.Lock()
+    self.processes = set()
+    self.result = None
+    self.pool = None
+    # called once all the formulas have been rendered or given up on, even if
+    # rendering one of them raised
+    self.finish = None
+    self.finished = False
+
+  def run(self, name, args):
+    """
+    Run a command, under the instrumentation phase `name`.  Returns False if
+    it had to be killed (or the job was cancelled), True otherwise.  What it
+    writes to stderr is only printed if it fails.
+    """
+    if self.cancelled.is_set():
+      return False
+    with instrument.phase(name):
+      # in a process group of its own, so that whatever it starts is killed
+      # along with it
+      p = subprocess.Popen(args, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, preexec_fn=os.setsid)
+      with self.lock:
+        self.processes.add(p)
+      timer = None
+      if self.timeout is not None:
+        timer = threading.Timer(self.timeout, self._kill, [p])
+        timer.start()
+      try:
+        out, err = p.communicate()
+      finally:
+        if timer is not None:
+          timer.cancel()
+        with self.lock:
+          self.processes.discard(p)
+    err = err.strip()
+    if p.returncode < 0 or self.cancelled.is_set():
+      print "Error: %s was stopped.%s" % (args[0], err and "\n" + err)
+      return False
+    if p.returncode != 0 and err:
+      print "Error: %s exited with status %d:\n%s" % (args[0], p.returncode,
+        err)
+    return True
+
+  def _kill(self, p):
+    try:
+      os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+  def cancel(self):
+    "Stop rendering: kill the running processes and skip the others."
+    self.cancelled.set()
+    with self.lock:
+      for p in list(self.processes):
+        self._kill(p)
+
+  def wait(self):
+    "Wait until all the formulas have been rendered (or given up on)."
+    try:
+      if self.result is not None:
+        self.result.get()
+    finally:
+      if self.pool is not None:
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+      self._finish()
+
+  def _finish(self, _=None):
+    with self.lock:
+      if self.finished or self.finish is None:
+        return
+      self.finished = True
+    self.finish()
+
+def _render_formulas_as_pdf(formulas, macros, dirname, job):
+  """
+  Takes a list of LaTeX formulas and returns the path to a PDF with one
+  formula on each page, or None if pdflatex was stopped or didn't write one.
+  """
+  template = template_env("html").get_template("formula.tex")
+  tex = template.render({
+    "formulas": formulas,
+    "macros":   macros})
+  (f, path) = tempfile.mkstemp(dir=dirname)
+  os.close(f)
+  codecs.open(path, encoding="utf8", mode="w").write(tex)
+
+  if not job.run("images.pdflatex", ["pdflatex",
+      "-interaction=batchmode", "-output-dir=%s" % os.path.dirname(path),
+      path]):
+    return None
+  if not os.path.exists(path + ".pdf"):
+    print "Error: pdflatex did not write a PDF."
+    return None
+  return path + ".pdf"
+
+def _load_wand():
+  """
+  Return the triple (wand.image, white, WandException), or None if Wand can't
+  be used.
+  """
+  global _wand
+  with _wand_lock:
+    if _wand is None:
+      try:
+        import wand.image, wand.color, wand.exceptions
+        _wand = (wand.image, wand.color.Color("#FFFFFF"),
+                 wand.exceptions.WandException)
+      except ImportError:
+        _wand = False
+    return _wand or None
+
+def _convert_pdf_to_png_in_process(wand, pdfpath, pngpath):
+  """
+  Like convert -density 120 -trim -transparent #FFFFFF, through MagickWand
+  within this process.
+  """
+  (image, white, _) = wand
+  with instrument.phase("images.wand"):
+    with image.Image(filename=pdfpath, resolution=120) as pdf:
+      for (i, page) in enumerate(pdf.sequence):
+        path = pngpath % i if "%d" in pngpath else pngpath
+        with image.Image(image=page) as img:
+          img.trim()
+          img.transparent_color(white, 0)
+          img.format = "png"
+          img.save(filename=path)
+        if "%d" not in pngpath:
+          break
+  return True
+
+def _convert_pdf_to_png(pdfpath, pngpath, job):
+  """
+  Convert a PDF to PNG.  If the PDF has several pages, pngpath should
+  contain a %d, which is replaced by the page number (starting at 0).
+  Returns False if convert was stopped.
+
+  With job.rasterizer "wand", this is done within the process with Wand (if
+  Wand and the MagickWand library are installed), which saves starting
+  convert and loading ImageMagick for each PDF.  It can't be stopped by the
+  timeout, though.  Otherwise, or if MagickWand fails, convert is run.
+  """
+  if job.rasterizer == "wand":
+    wand = _load_wand()
+    if wand is not None:
+      try:
+        return _convert_pdf_to_png_in_process(wand, pdfpath, pngpath)
+      except wand[2] as e:
+        print "Error: Wand could not convert %s (%s), running convert." % (
+          pdfpath, e)
+  return job.run("images.convert", ["convert",
+    "-density", "120", "-trim", "-transparent", "#FFFFFF",
+    pdfpath, pngpath])
+
+def get_formula_png_path(formula, macros, img_dir):
+  return "%s/%s" % (img_dir, formula_filename(formula, macros))
+
+def _render_one(formula, macros, cache, job):
+  name = formula_filename(formula, macros)
+  print "Rendering formula...\n%s" % formula
+  dirname = tempfile.mkdtemp()
+  try:
+    pdfpath = _render_formulas_as_pdf([formula], used_macros(formula, macros),
+      dirname, job)
+    if pdfpath is None:
+      return
+    tmppath = cache.temp_path()
+    if _convert_pdf_to_png(pdfpath, tmppath, job):
+      cache.commit(tmppath, name)
+    else:
+      os.remove(tmppath)
+  finally:
+    shutil.rmtree(dirname, ignore_errors=True)
+
+def render_formula_as_image(formula, macros, img_dir, timeout=None,
+                            rasterizer="convert"):
+  "Takes a LaTeX formula and returns a path to a PNG."
+  cache = get_cache(img_dir)
+  name = formula_filename(formula, macros)
+  if not cache.has(name):
+    _render_one(formula, macros, cache, RenderJob(timeout, rasterizer))
+    cache.save()
+  return cache.image_path(name)
+
+def _render_batch(batch, cache, job):
+  """
+  Render a list of (formula, macros) with a single run of pdflatex.  If the
+  PDF doesn't come out with one page per formula (e.g. because one of them
+  has an error or pdflatex timed out), the formulas are rendered one at a
+  time instead.
+  """
+  macros = {}
+  for (formula, m) in batch:
+    macros.update(used_macros(formula, m))
+  formulas = [formula for (formula, _) in batch]
+  print "Rendering %d formulas..." % len(formulas)
+  dirname = tempfile.mkdtemp()
+  try:
+    pdfpath = _render_formulas_as_pdf(formulas, sorted(macros.items()),
+      dirname, job)
+    if pdfpath is not None:
+      _convert_pdf_to_png(pdfpath, "%s/page-%%d.png" % dirname, job)
+    if job.cancelled.is_set():
+      return
+    pages = ["%s/page-%d.png" % (dirname, i) for i in range(len(batch))]
+    if not all(os.path.exists(p) for p in pages) or os.path.exists(
+        "%s/page-%d.png" % (dirname, len(batch))):
+      for (formula, m) in batch:
+        _render_one(formula, m, cache, job)
+      return
+    for (page, (formula, m)) in zip(pages, batch):
+      tmppath = cache.temp_path()
+      shutil.move(page, tmppath)
+      cache.commit(tmppath, formula_filename(formula, m))
+  finally:
+    shutil.rmtree(dirname, ignore_errors=True)
+
+def _chunks(l, n):
+  "Split l into n lists of about the same size."
+  size = (len(l) + n - 1) // n
+  return [l[i:i + size] for i in range(0, len(l), size)]
+
+def render_formulas_as_images(formulas, img_dir, jobs=1, batch=False,
+                              max_size=None, timeout=None, background=False,
+                              rasterizer="convert"):
+  """
+  Takes a list of pairs (formula, macros) and makes sure that the cache in
+  img_dir has a PNG for each of them, rendering the missing ones on a pool
+  of `jobs` threads.  With `batch`, the missing formulas are rendered in a
+  few multi-page runs of pdflatex (one per thread) instead of one run each.
+  If max_size is given, the least recently used images are then evicted
+  until the cache takes at most max_size bytes.  Runs of pdflatex or convert
+  taking more than `timeout` seconds are killed, and their formulas are left
+  without an image.  With rasterizer "wand", PDFs are converted to PNG
+  within the process when possible (see _convert_pdf_to_png).
+
+  Returns a RenderJob.  With `background`, the formulas are still being
+  rendered when it is returned; call its wait() (or cancel()) method.
+  """
+  jobs = max(1, jobs)
+  cache = get_cache(img_dir)
+  names = set()
+  missing = []
+  for (formula, macros) in formulas:
+    name = formula_filename(formula, macros)
+    if name not in names:
+      names.add(name)
+      if not cache.lookup(name):
+        missing.append((formula, macros))
+  instrument.count("images.rendered", len(missing))
+
+  job = RenderJob(timeout, rasterizer)
+  if batch:
+    tasks = _chunks(missing, jobs) if missing else []
+    work = lambda x: _render_batch(x, cache, job)
+  else:
+    tasks = missing
+    work = lambda x: _render_one(x[0], x[1], cache, job)
+
+  def finish():
+    if max_size is not None:
+      cache.evict(max_size, names)
+    cache.save()
+  job.finish = finish
+
+  if not background and (jobs <= 1 or len(tasks) <= 1):
+    try:
+      map(work, tasks)
+    finally:
+      job._finish()
+    return job
+  from multiprocessing.pool import ThreadPool
+  job.pool = ThreadPool(max(1, min(jobs, len(tasks))))
+  job.result = job.pool.map_async(work, tasks, 1, job._finish)
+  if not background:
+    job.wait()
+  return job
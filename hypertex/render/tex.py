@@ -1,12 +1,21 @@
 __name__ = "tex"
 
 import os.path
-from jinja2 import Environment, PackageLoader
 
+from hypertex import instrument
 from hypertex.constants import BLOCK_TAGS
+from hypertex.render import template_env
 from hypertex.util import dict_merge
 
-tmpl_env = Environment(loader=PackageLoader("hypertex.render", "tex"))
+# name => template, for the templates loaded so far
+_templates = {}
+
+def _template(name):
+  "Return the template called name, which is only looked up once."
+  template = _templates.get(name)
+  if template is None:
+    template = _templates[name] = template_env("tex").get_template(name)
+  return template
 
 def _render_content(node, parsed, config):
   if type(node) in (str, unicode):
@@ -25,13 +34,12 @@ def _render_citation(node, parsed, config):
   else:
     url = "#%d" % par
 
-  template = tmpl_env.get_template("citation.tex")
-  content = template.render({
-    "doc":  doc,
-    "num":  str(par),
-    "url":  url,
-    "text": text})
-  return content
+  # the same as citation.tex, without going through Jinja
+  if text:
+    return u"\\href{%s}{%s}" % (url, text)
+  elif doc:
+    return u"(\\href{%s}{%s/%s})" % (url, doc, par)
+  return u"(\\href{%s}{%s})" % (url, par)
 
 def _render_external_citation(node, parsed, config):
   ref = node.get("ref", "")
@@ -48,13 +56,8 @@ def _render_term(node, parsed, config):
   else:
     url = "#%d" % par
 
-  template = tmpl_env.get_template("term.tex")
-  content = template.render({
-    "doc":  doc,
-    "num":  str(par),
-    "url":  url,
-    "text": text})
-  return content
+  # the same as term.tex, without going through Jinja
+  return u"\\href{%s}{%s}" % (url, text)
 
 def _render_formula(node, parsed, config):
   return "\\[%s\\]" % _render_content(node, parsed, config)
@@ -77,54 +80,79 @@ def _render_subscript(node, parsed, config):
 def _render_superscript(node, parsed, config):
   return "\\textsuperscript{%s}</sup>" % _render_content(node, parsed, config)
 
+def _render_block(node, parsed, config):
+  content = _render_content(node, parsed, config)
+  template = _template("block.tex")
+  return template.render({"block": dict_merge(node, {"content": content})})
+
+# node type => format string for nodes that just wrap their content
+_WRAPPERS = {
+  "paragraph":  "%s\n",
+  "bold":       "\\textbf{%s}",
+  "italic":     "\\emph{%s}",
+  "definition": "\\emph{%s}"}
+
+# node type => function that renders it
+_RENDERERS = dict([(t, _render_block) for t in BLOCK_TAGS] + [
+  ("citation",    _render_citation),
+  ("term",        _render_term),
+  ("formula",     _render_formula),
+  ("ord_list",    _render_ord_list),
+  ("unord_list",  _render_unord_list),
+  ("list_item",   _render_list_item),
+  ("subscript",   _render_subscript),
+  ("superscript", _render_superscript)])
+
 def _render_node(node, parsed, config):
   if type(node) in (str, unicode):
     return node
+  type_ = node.get("type")
+  renderer = _RENDERERS.get(type_)
+  if renderer is not None:
+    return renderer(node, parsed, config)
   content = _render_content(node, parsed, config)
-
-  if node.get("type") in BLOCK_TAGS:
-    template = tmpl_env.get_template("block.tex")
-    return template.render({"block": dict_merge(node, {"content": content})})
-  if node.get("type") == "paragraph":
-    return "%s\n" % content
-  if node.get("type") == "bold":
-    return "\\textbf{%s}" % content
-  if node.get("type") == "italic":
-    return "\\emph{%s}" % content
-  if node.get("type") == "definition":
-    return "\\emph{%s}" % content
-  if node.get("type") == "citation":
-    return _render_citation(node, parsed, config)
-  if node.get("type") == "term":
-    return _render_term(node, parsed, config)
-  if node.get("type") == "formula":
-    return _render_formula(node, parsed, config)
-  if node.get("type") == "ord_list":
-    return _render_ord_list(node, parsed, config)
-  if node.get("type") == "unord_list":
-    return _render_unord_list(node, parsed, config)
-  if node.get("type") == "list_item":
-    return _render_list_item(node, parsed, config)
-  if node.get("type") == "subscript":
-    return _render_subscript(node, parsed, config)
-  if node.get("type") == "superscript":
-    return _render_superscript(node, parsed, config)
+  if type_ in _WRAPPERS:
+    return _WRAPPERS[type_] % content
   return content
 
 def _render_par(par, parsed, config):
   return "".join(_render_node(n, parsed, config)
     for n in par.get("content"))
 
-def render(parsed, config):
+def _make_config(config):
   config = dict_merge({"src_base_url": ""}, config)
-  base = config["src_base_url"]
+  # no base url (None) means relative links
+  base = config["src_base_url"] or ""
   if base and not base.endswith("/"):
-    config["src_base_url"] = base + "/"
-  template = tmpl_env.get_template("template.tex")
-  tex = template.render({
+    base += "/"
+  config["src_base_url"] = base
+  return config
+
+def _template_vars(parsed, pars):
+  return {
     "title":  parsed["title"],
     "author": parsed["author"],
     "macros": parsed["macros"].items(),
-    "pars":   [dict_merge(p, {"content": _render_par(p, parsed, config)})
-                for p in parsed["body"]["pars"]]})
-  return tex
+    "pars":   pars}
+
+def render(parsed, config):
+  config = _make_config(config)
+  with instrument.phase("render.tex"):
+    template = _template("template.tex")
+    with instrument.phase("render.tex.pars"):
+      pars = [dict_merge(p, {"content": _render_par(p, parsed, config)})
+        for p in parsed["body"]["pars"]]
+    with instrument.phase("render.tex.template"):
+      return template.render(_template_vars(parsed, pars))
+
+def render_stream(parsed, config):
+  """
+  Like render(), but returns a generator of pieces of the LaTeX source, and
+  renders each par only when the template reaches it.  Meant for the result
+  of hypertex.parser.iterparse.
+  """
+  config = _make_config(config)
+  template = _template("template.tex")
+  pars = (dict_merge(p, {"content": _render_par(p, parsed, config)})
+    for p in parsed["body"]["pars"])
+  return template.generate(_template_vars(parsed, pars))
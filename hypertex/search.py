@@ -0,0 +1,329 @@
+__name__ = "search"
+
+import os
+import re
+import json
+import math
+import heapq
+import tempfile
+
+import hypertex.parser
+from hypertex import instrument
+from hypertex.constants import BLOCK_TAGS
+
+SEARCH_VERSION = 2
+
+# the fields of a par: its text (with the text of definitions and terms, but
+# without formulas), the text of its definitions and of its terms, the types
+# of its blocks (e.g. thm), and the TeX of its formulas
+FIELDS = ["text", "def", "term", "block", "formula"]
+
+# the fields searched by a word which doesn't name one (as in def:word)
+DEFAULT_FIELDS = ["text", "formula"]
+
+# field => weight of a match in the score of a par
+WEIGHTS = {"text": 1.0, "def": 3.0, "term": 2.0, "block": 1.0, "formula": 1.0}
+
+SNIPPET_LENGTH = 160
+
+_WORD = re.compile(r"\\?\w+", re.U)
+_INLINE_FORMULA = re.compile(r"\$[^$]*\$")
+_SPACE_BEFORE_PUNCTUATION = re.compile(r"\s+(?=[.,;:!?)])")
+
+# the nodes whose text is kept apart from the text around them
+_SEPARATE = BLOCK_TAGS + ["ord_list", "unord_list", "list_item"]
+
+_indices = {}
+
+def _tokens(text):
+  return set(_WORD.findall(text.lower()))
+
+def _field_tokens(field, text):
+  "The words under which the text of a field is indexed."
+  if field == "text":
+    return _tokens(_INLINE_FORMULA.sub(" ", text))
+  words = _tokens(text)
+  if field == "formula":
+    # so that \pi is found by looking for pi too
+    words.update([w.lstrip("\\") for w in words])
+  return words
+
+def _text(node):
+  if type(node) in (str, unicode):
+    return node
+  return "".join(_text(x) for x in node.get("content"))
+
+def _collect(node, fields):
+  """
+  Add the text of node to the lists of pieces of each field in `fields`,
+  returning its plain text.
+  """
+  if type(node) in (str, unicode):
+    fields["text"].append(node)
+    return node
+  type_ = node.get("type")
+  if type_ == "formula":
+    fields["formula"].append(_text(node))
+    return ""
+  if type_ in BLOCK_TAGS:
+    fields["block"].append(type_)
+  if type_ in _SEPARATE:
+    fields["text"].append(" ")
+  pieces = [_collect(x, fields) for x in node.get("content")]
+  if type_ in _SEPARATE:
+    fields["text"].append(" ")
+  if type_ == "definition":
+    fields["def"].append("".join(pieces))
+  elif type_ == "term":
+    fields["term"].append("".join(pieces))
+  return "".join(pieces)
+
+def par_fields(par):
+  """
+  Return the list of the texts of the fields (see FIELDS) of a parsed par.
+  Inline formulas ($...$) count as formulas rather than as text.  Runs of
+  whitespace in the text, including the ones left by citations without
+  text, are collapsed, and dropped before punctuation.
+  """
+  fields = dict((f, []) for f in FIELDS)
+  _collect(par, fields)
+  text = " ".join("".join(fields["text"]).split())
+  text = _SPACE_BEFORE_PUNCTUATION.sub("", text)
+  fields["formula"].extend(m[1:-1] for m in _INLINE_FORMULA.findall(text))
+  values = [text]
+  for f in FIELDS[1:]:
+    values.append(" ".join(fields[f]))
+  return values
+
+def _snippet(text, words):
+  "A piece of text of about SNIPPET_LENGTH characters around one of words."
+  start = 0
+  lower = text.lower()
+  for word in words:
+    m = re.search(r"(?<!\w)%s(?!\w)" % re.escape(word), lower, re.U)
+    if m:
+      start = max(0, m.start() - SNIPPET_LENGTH / 4)
+      break
+  snippet = text[start:start + SNIPPET_LENGTH]
+  if start > 0:
+    snippet = "..." + snippet
+  if start + SNIPPET_LENGTH < len(text):
+    snippet = snippet + "..."
+  return snippet
+
+def parse_query(query):
+  """
+  Split a query into a list of pairs (fields, word).  A word may be
+  restricted to a field by prefixing it with the field's name, as in
+  "def:simplicial" or "block:thm"; other words are looked up in
+  DEFAULT_FIELDS.
+  """
+  terms = []
+  for part in query.split():
+    fields = DEFAULT_FIELDS
+    (name, sep, rest) = part.partition(":")
+    if sep and name in FIELDS:
+      (fields, part) = ([name], rest)
+    for word in sorted(_tokens(part)):
+      terms.append((fields, word))
+  return terms
+
+class SearchIndex(object):
+  """
+  An inverted index of the pars of the documents in src_dir, with a
+  postings set field => word => par ids for each of FIELDS.
+
+  The texts of the fields of each par are stored, in the file at path if
+  one is given, and the postings are made from them when the index is
+  loaded and kept up to date as documents are recorded.  Call refresh() to
+  bring the index up to date with src_dir, and search() to query it.
+  """
+
+  def __init__(self, src_dir, path=None):
+    self.src_dir = src_dir
+    self.path = path
+    # doc => {"mtime", "size", "hash", "pars": [[n, text, def, ...], ...]}
+    self.docs = {}
+    # field => word => set of par ids
+    self.postings = dict((f, {}) for f in FIELDS)
+    # par id => (doc, par number, texts of the fields)
+    self.pars = {}
+    # doc => ids of its pars
+    self.doc_ids = {}
+    self.next_id = 0
+    self.dirty = False
+    if path:
+      self._load()
+
+  def _load(self):
+    try:
+      data = json.load(open(self.path, "r"))
+    except (IOError, ValueError):
+      return
+    if data.get("version") != SEARCH_VERSION:
+      return
+    self.docs = data.get("docs", {})
+    for (doc, entry) in self.docs.items():
+      self._add(doc, entry["pars"])
+
+  def save(self):
+    if not self.path or not self.dirty:
+      return
+    dirname = os.path.dirname(self.path)
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    (f, tmppath) = tempfile.mkstemp(dir=dirname)
+    with os.fdopen(f, "w") as out:
+      json.dump({"version": SEARCH_VERSION, "docs": self.docs}, out,
+        separators=(",", ":"))
+    os.rename(tmppath, self.path)
+    self.dirty = False
+
+  def _add(self, doc, pars):
+    ids = []
+    for par in pars:
+      i = self.next_id
+      self.next_id += 1
+      self.pars[i] = (doc, par[0], par[1:])
+      for (field, text) in zip(FIELDS, par[1:]):
+        postings = self.postings[field]
+        for word in _field_tokens(field, text):
+          postings.setdefault(word, set()).add(i)
+      ids.append(i)
+    self.doc_ids[doc] = ids
+
+  def _remove(self, doc):
+    for i in self.doc_ids.pop(doc, []):
+      (_, n, texts) = self.pars.pop(i)
+      for (field, text) in zip(FIELDS, texts):
+        postings = self.postings[field]
+        for word in _field_tokens(field, text):
+          postings[word].discard(i)
+          if not postings[word]:
+            del postings[word]
+
+  def record(self, doc, entry, parsed):
+    """
+    Index the pars of `doc`, given its parse and the mtime, size and md5
+    hash of its source in `entry`.
+    """
+    pars = [[i + 1] + par_fields(p)
+      for (i, p) in enumerate(parsed["body"]["pars"])]
+    old = self.docs.get(doc)
+    if old is not None:
+      if old["hash"] == entry["hash"] and old["pars"] == pars:
+        return
+      self._remove(doc)
+    self.docs[doc] = {"mtime": entry["mtime"], "size": entry["size"],
+                      "hash": entry["hash"], "pars": pars}
+    self._add(doc, pars)
+    self.dirty = True
+
+  def remove(self, doc):
+    if self.docs.pop(doc, None) is not None:
+      self._remove(doc)
+      self.dirty = True
+
+  def refresh(self, docs, parse_config={}):
+    """
+    Bring the index up to date, given the map doc => entry (mtime, size and
+    md5 hash, see hypertex.build.documents) of every document in src_dir.
+    The documents whose source changed since they were indexed are parsed
+    again, and those that no longer exist are removed.
+    """
+    with instrument.phase("search.refresh"):
+      for doc in list(self.docs):
+        if doc not in docs:
+          self.remove(doc)
+      parse_config = dict(parse_config, src_dir=self.src_dir)
+      for doc in sorted(docs):
+        old = self.docs.get(doc)
+        if old is not None and old["hash"] == docs[doc]["hash"]:
+          continue
+        instrument.count("search.parses")
+        path = "%s/%s.xml" % (self.src_dir, doc)
+        with hypertex.parser.map_source(path) as htex:
+          parsed = hypertex.parser.parse(htex, parse_config)
+        self.record(doc, docs[doc], parsed)
+
+  def search(self, query, limit=20):
+    """
+    Return the `limit` best pars (or all of them if limit is None) matching
+    every word of the query (see parse_query), as a list of dicts with the
+    doc, the par number, a snippet of the text and a score, best first.  A
+    match counts for more in a rare word, and in a definition or a term than
+    in the text.
+    """
+    with instrument.phase("search.query"):
+      terms = parse_query(query)
+      if not terms:
+        return []
+      matches = []
+      for (fields, word) in terms:
+        # par id => score of this word
+        found = {}
+        for field in fields:
+          ids = self.postings[field].get(word, ())
+          if not ids:
+            continue
+          weight = WEIGHTS[field] * math.log(
+            1.0 + float(len(self.pars)) / len(ids))
+          if not found:
+            found = dict.fromkeys(ids, weight)
+            continue
+          for i in ids:
+            found[i] = found.get(i, 0) + weight
+        matches.append(found)
+      matches.sort(key=len)
+      scores = matches[0]
+      for found in matches[1:]:
+        scores = dict((i, s + found[i]) for (i, s) in scores.iteritems()
+          if i in found)
+      key = lambda x: (-x[1], self.pars[x[0]][:2])
+      if limit is None:
+        best = sorted(scores.iteritems(), key=key)
+      else:
+        best = heapq.nsmallest(limit, scores.iteritems(), key=key)
+      words = [word for (fields, word) in terms]
+      return [{"doc":     self.pars[i][0],
+               "par":     self.pars[i][1],
+               "snippet": _snippet(self.pars[i][2][0], words),
+               "score":   s} for (i, s) in best]
+
+  def export(self, path):
+    """
+    Write the index as a single JSON file for searching on the client side:
+    {"fields": FIELDS, "pars": [[doc, par number, snippet], ...],
+     "postings": {field: {word: [par index, ...]}}}.
+    """
+    ids = sorted(self.pars, key=lambda i: self.pars[i][:2])
+    index = dict((i, k) for (k, i) in enumerate(ids))
+    pars = [[self.pars[i][0], self.pars[i][1], _snippet(self.pars[i][2][0], [])]
+      for i in ids]
+    postings = {}
+    for field in FIELDS:
+      postings[field] = dict((word, sorted(index[i] for i in found))
+        for (word, found) in self.postings[field].iteritems())
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    (f, tmppath) = tempfile.mkstemp(dir=dirname)
+    with os.fdopen(f, "w") as out:
+      json.dump({"version": SEARCH_VERSION, "fields": FIELDS, "pars": pars,
+                 "postings": postings}, out, separators=(",", ":"),
+        sort_keys=True)
+    os.rename(tmppath, path)
+
+def get_search_index(src_dir, cache_dir=None):
+  """
+  Return the search index of src_dir, which is shared by everything in the
+  process that uses the same src_dir and cache_dir.
+  """
+  src_dir = os.path.abspath(src_dir)
+  key = (src_dir, cache_dir)
+  if key not in _indices:
+    path = None
+    if cache_dir:
+      path = os.path.join(cache_dir, "search.json")
+    _indices[key] = SearchIndex(src_dir, path)
+  return _indices[key]
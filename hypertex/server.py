@@ -0,0 +1,141 @@
+__name__ = "server"
+
+import os
+import re
+import sys
+import threading
+import traceback
+import BaseHTTPServer
+import SocketServer
+
+import hypertex.parser
+from hypertex import index, build
+from hypertex.render import renderer
+
+CONTENT_TYPES = {"html": "text/html; charset=utf-8",
+                 "tex":  "text/x-tex; charset=utf-8"}
+
+def _stat(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime, st.st_size)
+
+class Renderer(object):
+  """
+  Renders the documents in src_dir, keeping each parsed document and its
+  outputs in memory.  They are thrown away as soon as the mtime or size of
+  the source or of one of its macro or reference files changes, or one of
+  its external citations resolves to a different par.  Safe to use from
+  several threads, which only wait for each other to render the same
+  document.
+  """
+
+  def __init__(self, src_dir, parse_config={}, render_configs={}):
+    self.src_dir = os.path.abspath(src_dir)
+    cache_dir = parse_config.get("cache_dir")
+    self.tag_index = index.get_tag_index(self.src_dir, cache_dir)
+    self.parse_config = dict(parse_config, src_dir=self.src_dir,
+      tag_index=self.tag_index)
+    self.render_configs = render_configs
+    self.docs = {}
+    # doc => lock held while it is loaded or rendered
+    self.locks = {}
+    self.lock = threading.Lock()
+
+  def _is_valid(self, entry):
+    if _stat(entry["path"]) != entry["stat"]:
+      return False
+    for (path, st) in entry["files"].items():
+      if _stat(path) != st:
+        return False
+    for (doc, tag, par) in entry["citations"]:
+      if (self.tag_index.lookup(doc, tag) or 0) != par:
+        return False
+    return True
+
+  def _load(self, doc):
+    path = "%s/%s.xml" % (self.src_dir, doc)
+    st = _stat(path)
+    if st is None:
+      return None
+    # read rather than mapped: the source may be truncated by an editor while
+    # it is parsed, which is fatal to a process reading it through a mapping
+    htex = open(path, "rb").read()
+    if not build._is_document(htex):
+      return None
+    parsed = hypertex.parser.parse(htex, self.parse_config)
+    return {
+      "path":      path,
+      "stat":      st,
+      "files":     dict((f, _stat(f)) for f in parsed["deps"]["files"]),
+      "citations": parsed["deps"]["citations"],
+      "parsed":    parsed,
+      "outputs":   {}}
+
+  def _doc_lock(self, doc):
+    with self.lock:
+      return self.locks.setdefault(doc, threading.Lock())
+
+  def render(self, doc, format):
+    "Return the rendering of doc in the given format, or None if there's no doc."
+    if _stat("%s/%s.xml" % (self.src_dir, doc)) is None:
+      self.docs.pop(doc, None)
+      return None
+    with self._doc_lock(doc):
+      self.tag_index.begin_run()
+      entry = self.docs.get(doc)
+      if entry is None or not self._is_valid(entry):
+        entry = self._load(doc)
+        if entry is None:
+          self.docs.pop(doc, None)
+          return None
+        self.docs[doc] = entry
+      if format not in entry["outputs"]:
+        entry["outputs"][format] = renderer(format).render(entry["parsed"],
+          self.render_configs.get(format, {}))
+      return entry["outputs"][format]
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  "Serves /DOC.html and /DOC.tex, for each document DOC in src_dir."
+
+  def do_GET(self):
+    m = re.match(r"^/([^/?#]+)\.(html|tex)(\?.*)?$", self.path)
+    output = None
+    if m and not m.group(1).startswith("."):
+      try:
+        output = self.server.renderer.render(m.group(1), m.group(2))
+      except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        self.send_error(500, "Could not render %s.%s: %s" % (m.group(1),
+          m.group(2), type(e).__name__))
+        return
+    if output is None:
+      self.send_error(404)
+      return
+    body = output.encode("utf8", "ignore")
+    self.send_response(200)
+    self.send_header("Content-Type", CONTENT_TYPES[m.group(2)])
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, renderer):
+    BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+    self.renderer = renderer
+
+def serve(src_dir, host="localhost", port=8000, parse_config={},
+          render_configs={}):
+  "Serve the documents in src_dir over HTTP until interrupted."
+  server = Server((host, port), Renderer(src_dir, parse_config, render_configs))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    server.renderer.tag_index.save()
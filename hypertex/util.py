@@ -1,4 +1,34 @@
 __name__ = "util"
 
+import fcntl
+from contextlib import contextmanager
+
 def dict_merge(d, e):
-  return dict(list(d.items()) + list(e.items()))
+  r = dict(d)
+  r.update(e)
+  return r
+
+class FrozenDict(dict):
+  "A dict which can't be modified, so that it can be shared safely."
+
+  def _immutable(self, *args, **kwargs):
+    raise TypeError("FrozenDict is immutable")
+
+  __setitem__ = __delitem__ = _immutable
+  clear = pop = popitem = setdefault = update = _immutable
+
+  def __reduce__(self):
+    return (FrozenDict, (dict(self),))
+
+@contextmanager
+def locked(path):
+  """
+  Hold an exclusive lock on the file at path (which is created if needed),
+  so that processes updating a shared file do it one at a time.
+  """
+  with open(path, "a") as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
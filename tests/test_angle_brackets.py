@@ -0,0 +1,176 @@
+"""
+Tests of the escaping of stray angle brackets done before sources are given
+to lxml (hypertex.parser._fix_angle_brackets and friends), with a fuzz
+harness comparing the whole-text, chunked and bytes paths.  Run
+
+  python tests/test_angle_brackets.py --fuzz N
+
+to fuzz with N random sources instead of running the tests.
+"""
+
+import os
+import sys
+import random
+import tempfile
+import unittest
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from hypertex import parser
+
+# the pieces fuzzed sources are made of, with every kind of thing that the
+# escaping treats differently, and pieces of them
+PIECES = [u"<b>", u"</b>", u"x", u" ", u"<", u">", u"a<b", u"1 <2", u"<1",
+  u"<!-- c < -->", u"<!--", u"-->", u"<![CDATA[ <q ]]>", u"<![CDATA[",
+  u"]]>", u"]]", u"]", u"\u00e9", u"<br/>", u"<?pi x?>"]
+
+def _fix_in_chunks(text, sizes):
+  """
+  Apply _fix_angle_brackets to text the way _SourceReader does: in chunks of
+  the given sizes, only ever cutting where _fix_angle_brackets_cut allows.
+  """
+  out = []
+  carry = u""
+  pos = 0
+  for size in sizes:
+    if pos >= len(text):
+      break
+    chunk = carry + text[pos:pos + size]
+    pos += size
+    cut = parser._fix_angle_brackets_cut(chunk)
+    carry = chunk[cut:]
+    out.append(parser._fix_angle_brackets(chunk[:cut]))
+  out.append(parser._fix_angle_brackets(carry + text[pos:]))
+  return u"".join(out)
+
+def _tree(parse, source):
+  """
+  The canonical serialization of the tree parsed from source (an empty
+  CDATA section gives an empty text in one parser and none in the other), or
+  "error" if it isn't well-formed (lxml sometimes raises a TypeError rather
+  than an XMLSyntaxError while formatting the message for unicode input).
+  """
+  try:
+    return etree.tostring(parse(source), method="c14n")
+  except (etree.XMLSyntaxError, TypeError):
+    return "error"
+
+def fuzz(iterations, seed=0):
+  """
+  Check on `iterations` random sources that the escaping gives the same
+  result on the whole text, in random chunks, and on the bytes fed to lxml
+  by _read_xml.  Returns the list of sources for which it doesn't.
+  """
+  rng = random.Random(seed)
+  failures = []
+  for _ in range(iterations):
+    body = u"".join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+    whole = parser._fix_angle_brackets(body)
+    sizes = [rng.randint(1, 8) for _ in range(len(body))]
+    if _fix_in_chunks(body, sizes) != whole:
+      failures.append(body)
+      continue
+    src = u"<document><body><par>%s</par></body></document>" % body
+    expected = _tree(lambda s: etree.fromstring(parser._fix_angle_brackets(s)),
+      src)
+    actual = _tree(lambda s: parser._read_xml(s, rng.randint(1, 16)),
+      src.encode("utf8"))
+    if expected != actual:
+      failures.append(body)
+  return failures
+
+class FixAngleBracketsTest(unittest.TestCase):
+
+  def fix(self, text):
+    return parser._fix_angle_brackets(text)
+
+  def test_stray_less_than_is_escaped(self):
+    self.assertEqual(self.fix(u"$0 < x <1$"), u"$0 &lt; x &lt;1$")
+
+  def test_tags_are_left_alone(self):
+    for text in [u"a<b>c</b>", u"<br/>", u"<?pi x?>", u"<x:y/>", u"<_a/>"]:
+      self.assertEqual(self.fix(text), text)
+
+  def test_greater_than_is_left_alone(self):
+    self.assertEqual(self.fix(u"$y > 0$ and $a>b$"), u"$y > 0$ and $a>b$")
+
+  def test_comments_and_cdata_are_left_alone(self):
+    text = u"a <!-- 1 < 2 ]]> --> b <![CDATA[ 1 < 2 ]]> c"
+    self.assertEqual(self.fix(text), text)
+
+  def test_cdata_end_outside_cdata_is_escaped(self):
+    self.assertEqual(self.fix(u"a ]]> b"), u"a ]]&gt; b")
+
+  def test_unterminated_comment(self):
+    self.assertEqual(self.fix(u"a <!-- b < c"), u"a <!-- b &lt; c")
+
+  def test_unterminated_cdata(self):
+    self.assertEqual(self.fix(u"<![CDATA[ open <"), u"<![CDATA[ open &lt;")
+
+  def test_bytes(self):
+    self.assertEqual(self.fix("1 < 2 ]]>"), "1 &lt; 2 ]]&gt;")
+
+class FixAngleBracketsCutTest(unittest.TestCase):
+
+  def cut(self, text):
+    return parser._fix_angle_brackets_cut(text)
+
+  def test_cut_before_last_less_than(self):
+    self.assertEqual(self.cut(u"<p>x</p> <"), 9)
+    self.assertEqual(self.cut(u"a<b"), 1)
+
+  def test_cut_before_unterminated_comment(self):
+    self.assertEqual(self.cut(u"a <!-- b < c"), 2)
+    self.assertEqual(self.cut(u"a <!-- b --> <!-- c"), 13)
+
+  def test_cut_before_unterminated_cdata(self):
+    self.assertEqual(self.cut(u"<![CDATA[ open <"), 0)
+
+  def test_cut_after_closed_sections(self):
+    self.assertEqual(self.cut(u"x<![CDATA[ a<b ]]> y<z"), 20)
+    self.assertEqual(self.cut(u"<!-- a --> b"), 12)
+
+  def test_cut_does_not_split_cdata_end(self):
+    self.assertEqual(self.cut(u"a]]"), 1)
+    self.assertEqual(self.cut(u"a]"), 1)
+    self.assertEqual(self.cut(u"a ]]> b"), 7)
+
+  def test_less_than_at_chunk_boundary(self):
+    # "<" at the end of a chunk may start a tag in the next one
+    for text in [u"x <b>y</b>", u"x < y", u"x <!-- < --> y", u"x ]]> y"]:
+      for n in range(1, len(text)):
+        self.assertEqual(_fix_in_chunks(text, [n] * len(text)),
+          parser._fix_angle_brackets(text))
+
+class SourceReaderTest(unittest.TestCase):
+
+  def test_same_as_whole_text(self):
+    text = u"<document><body><par>$0 < x$ <!-- < --> \u00e9 ]]> " \
+           u"<![CDATA[ < ]]> <b>y</b></par></body></document>"
+    (f, path) = tempfile.mkstemp()
+    try:
+      os.write(f, text.encode("utf8"))
+      os.close(f)
+      for size in range(1, 12):
+        reader = parser._SourceReader(path, size)
+        try:
+          data = "".join(iter(lambda: reader.read(7), ""))
+        finally:
+          reader.close()
+        self.assertEqual(data.decode("utf8"), parser._fix_angle_brackets(text))
+    finally:
+      os.remove(path)
+
+class FuzzTest(unittest.TestCase):
+
+  def test_fuzz(self):
+    self.assertEqual(fuzz(2000), [])
+
+if __name__ == "__main__":
+  if sys.argv[1:2] == ["--fuzz"]:
+    failures = fuzz(int(sys.argv[2]), int(sys.argv[3]) if sys.argv[3:] else 0)
+    for body in failures:
+      print repr(body)
+    print "%d failures" % len(failures)
+    sys.exit(1 if failures else 0)
+  unittest.main()
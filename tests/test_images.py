@@ -0,0 +1,140 @@
+"""
+Tests of the formula image cache (hypertex.render.images.ImageCache) shared
+by several processes.
+"""
+
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from hypertex import parser
+from hypertex.render import images, html
+
+def _add_images(img_dir, i, n):
+  "Add n images to the cache in img_dir from a process of its own."
+  cache = images.ImageCache(img_dir)
+  for k in range(n):
+    name = "%d-%d.png" % (i, k)
+    cache.lookup(name)
+    tmppath = cache.temp_path()
+    open(tmppath, "w").write("png")
+    cache.commit(tmppath, name)
+    cache.save()
+
+class ImageCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.img_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.img_dir)
+
+  def test_image_mode(self):
+    cache = images.ImageCache(self.img_dir)
+    tmppath = cache.temp_path()
+    open(tmppath, "w").write("png")
+    cache.commit(tmppath, "a.png")
+    cache.save()
+    for path in [cache.image_path("a.png"), cache.path]:
+      self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), images.IMAGE_MODE)
+
+  def test_gc_keeps_temporary_files_in_use(self):
+    cache = images.ImageCache(self.img_dir)
+    for name in ["a.png", "b.png"]:
+      tmppath = cache.temp_path()
+      open(tmppath, "w").write("png")
+      cache.commit(tmppath, name)
+    fresh = cache.temp_path()
+    old = cache.temp_path()
+    os.utime(old, (0, 0))
+    removed = cache.gc(["a.png"])
+    self.assertEqual(sorted(removed), sorted(["b.png", os.path.basename(old)]))
+    self.assertTrue(os.path.exists(fresh))
+    open(fresh, "w").write("png")
+    self.assertTrue(cache.commit(fresh, "c.png"))
+
+  def test_concurrent_saves(self):
+    processes = [multiprocessing.Process(target=_add_images,
+      args=(self.img_dir, i, 10)) for i in range(4)]
+    for p in processes:
+      p.start()
+    for p in processes:
+      p.join()
+    cache = images.ImageCache(self.img_dir)
+    self.assertEqual(len(cache.images), 40)
+    self.assertEqual(cache.stats["misses"], 40)
+
+  def test_stats_are_added(self):
+    first = images.ImageCache(self.img_dir)
+    second = images.ImageCache(self.img_dir)
+    first.lookup("a.png")
+    first.save()
+    second.lookup("a.png")
+    second.lookup("b.png")
+    second.save()
+    first.lookup("c.png")
+    first.save()
+    self.assertEqual(images.ImageCache(self.img_dir).stats["misses"], 4)
+
+class RenderJobTest(unittest.TestCase):
+
+  def setUp(self):
+    self.img_dir = tempfile.mkdtemp()
+    self.render_one = images._render_one
+
+  def tearDown(self):
+    images._render_one = self.render_one
+    shutil.rmtree(self.img_dir)
+
+  def fake_render_one(self, formula, macros, cache, job):
+    if formula == "bad":
+      raise ValueError(formula)
+    tmppath = cache.temp_path()
+    open(tmppath, "w").write("png")
+    cache.commit(tmppath, images.formula_filename(formula, macros))
+
+  def test_manifest_saved_when_a_formula_fails(self):
+    images._render_one = self.fake_render_one
+    for jobs in [1, 2]:
+      formulas = [("x^%d" % jobs, {}), ("bad", {}), ("y^%d" % jobs, {})]
+      self.assertRaises(ValueError, images.render_formulas_as_images,
+        formulas, self.img_dir, jobs)
+      # on one thread, the formulas after the failed one are not rendered
+      rendered = formulas[:1] if jobs == 1 else formulas[::2]
+      cache = images.ImageCache(self.img_dir)
+      for (formula, macros) in rendered:
+        self.assertTrue(cache.has(images.formula_filename(formula, macros)))
+
+  def test_async_job_finished_when_rendering_fails(self):
+    images._render_one = self.fake_render_one
+    parsed = parser.parse(u"<document><head><title>t</title></head><body>"
+      u"<par><frml img=\"1\">x</frml><frml img=\"1\">y</frml></par>"
+      u"</body></document>", {})
+    jobs = []
+    render = images.render_formulas_as_images
+    def render_formulas_as_images(*args):
+      jobs.append(render(*args))
+      return jobs[-1]
+    render_pars = html._render_pars
+    def failing_render_pars(pars, parsed, config):
+      raise ValueError("render")
+    images.render_formulas_as_images = render_formulas_as_images
+    html._render_pars = failing_render_pars
+    try:
+      self.assertRaises(ValueError, html.render, parsed,
+        {"img_dir": self.img_dir, "async_formulas": True, "jobs": 2})
+    finally:
+      images.render_formulas_as_images = render
+      html._render_pars = render_pars
+    self.assertEqual(jobs[0].pool, None)
+    self.assertTrue(jobs[0].finished)
+    self.assertTrue(os.path.exists(os.path.join(self.img_dir,
+      "manifest.json")))
+
+if __name__ == "__main__":
+  unittest.main()
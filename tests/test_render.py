@@ -0,0 +1,65 @@
+"""
+Golden output tests: tests/sset.xml rendered in each format must be byte for
+byte the same as tests/sset.html and tests/sset.tex, which were made by the
+original renderers.
+"""
+
+import os
+import sys
+import codecs
+import unittest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS, ".."))
+from hypertex import parser
+from hypertex.render import html, tex
+
+def _read(name):
+  return codecs.open(os.path.join(TESTS, name), encoding="utf8",
+    mode="r").read()
+
+class RenderTest(unittest.TestCase):
+
+  def setUp(self):
+    # keep the errors about the missing cited document out of the output
+    self.stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    self.htex = _read("sset.xml")
+    self.config = {"src_dir": TESTS}
+
+  def tearDown(self):
+    sys.stdout.close()
+    sys.stdout = self.stdout
+
+  def check(self, renderer, golden, parse_config={}):
+    expected = _read(golden)
+    parsed = parser.parse(self.htex, dict(self.config, **parse_config))
+    # the second time, the templates come from the cache
+    for _ in range(2):
+      self.assertEqual(renderer.render(parsed, {}), expected)
+
+  def test_html(self):
+    self.check(html, "sset.html")
+
+  def test_tex(self):
+    self.check(tex, "sset.tex")
+
+  def test_html_nodes(self):
+    self.check(html, "sset.html", {"nodes": True})
+
+  def test_tex_nodes(self):
+    self.check(tex, "sset.tex", {"nodes": True})
+
+  def test_bytes(self):
+    with parser.map_source(os.path.join(TESTS, "sset.xml")) as htex:
+      parsed = parser.parse(htex, self.config)
+    self.assertEqual(html.render(parsed, {}), _read("sset.html"))
+
+  def test_stream(self):
+    for (renderer, golden) in [(html, "sset.html"), (tex, "sset.tex")]:
+      parsed = parser.iterparse(os.path.join(TESTS, "sset.xml"), self.config)
+      self.assertEqual(u"".join(renderer.render_stream(parsed, {})),
+        _read(golden))
+
+if __name__ == "__main__":
+  unittest.main()
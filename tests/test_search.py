@@ -0,0 +1,43 @@
+"""
+Tests of the texts of pars indexed by hypertex.search.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from hypertex import parser, search
+
+def _fields(body):
+  parsed = parser.parse(u"<document><body><par>%s</par><par tag=\"a\">a</par>"
+    u"</body></document>" % body, {})
+  return dict(zip(search.FIELDS, search.par_fields(parsed["body"]["pars"][0])))
+
+class ParFieldsTest(unittest.TestCase):
+
+  def test_citations_without_text(self):
+    self.assertEqual(_fields(u"See <cite tag=\"a\"/> and <cite tag=\"a\"/>.")
+      ["text"], u"See and.")
+
+  def test_no_space_before_punctuation(self):
+    self.assertEqual(_fields(u"See <cite tag=\"a\">this</cite>, <b>x</b> "
+      u"(<i>y</i>).")["text"], u"See this, x (y).")
+
+  def test_inline_nodes_do_not_split_words(self):
+    self.assertEqual(_fields(u"Word<b>s</b> and <term tag=\"a\">ter</term>m")
+      ["text"], u"Words and term")
+
+  def test_blocks_and_list_items_are_apart(self):
+    fields = _fields(u"<thm>A</thm><prf>B</prf><ul><li>one</li><li>two</li>"
+      u"</ul>")
+    self.assertEqual(fields["text"], u"A B one two")
+    self.assertEqual(fields["block"], u"thm prf")
+
+  def test_inline_formulas(self):
+    fields = _fields(u"Let $x < y$ be <frml>z^2</frml>.")
+    self.assertEqual(fields["text"], u"Let $x < y$ be.")
+    self.assertEqual(fields["formula"], u"z^2 x < y")
+
+if __name__ == "__main__":
+  unittest.main()